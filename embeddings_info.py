@@ -1,24 +1,111 @@
-from transformers import AutoTokenizer
+import os
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple
 import numpy as np
 
+TOKENIZER_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+PAGE_SIZE = 5000  # Chunks fetched from ChromaDB and tokenized per batch
+TOKEN_CACHE_PATH = os.path.expanduser('~/.cache/tryllm/tok_counts.sqlite')
+CACHE_LOOKUP_SIZE = 500  # Stay well under SQLite's bound parameter limit
+
+def open_token_cache(path: str = TOKEN_CACHE_PATH) -> sqlite3.Connection:
+    """Open the on-disk cache of token counts keyed by a hash of the chunk text"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS token_counts (h BLOB PRIMARY KEY, n INTEGER NOT NULL)")
+    return conn
+
+def lookup_cached_counts(conn: sqlite3.Connection, hashes: List[bytes]) -> Dict[bytes, int]:
+    """Fetch cached token counts for the given hashes"""
+    found = {}
+    for i in range(0, len(hashes), CACHE_LOOKUP_SIZE):
+        batch = hashes[i:i + CACHE_LOOKUP_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        found.update(conn.execute(f"SELECT h, n FROM token_counts WHERE h IN ({placeholders})", batch))
+    return found
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """Load the tokenizer matching your sentence-transformer model on first use"""
+    # Imported here so loading this module doesn't pull in transformers
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(TOKENIZER_NAME, use_fast=True)
+
+def count_tokens(docs: List[str], cache: sqlite3.Connection) -> Tuple[np.ndarray, int]:
+    """Count tokens for a batch of chunks, tokenizing only those missing from the cache"""
+    hashes = [hashlib.blake2b(doc.encode(), digest_size=16).digest() for doc in docs]
+    cached = lookup_cached_counts(cache, hashes)
+    
+    counts = np.empty(len(docs), dtype=np.int32)
+    misses = []
+    for i, h in enumerate(hashes):
+        if h in cached:
+            counts[i] = cached[h]
+        else:
+            misses.append(i)
+    
+    if misses:
+        # One batched call to the Rust tokenizer for all misses
+        enc = get_tokenizer()(
+            [docs[i] for i in misses],
+            add_special_tokens=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            return_length=True
+        )
+        counts[misses] = enc['length']
+        with cache:
+            cache.executemany(
+                "INSERT OR REPLACE INTO token_counts (h, n) VALUES (?, ?)",
+                zip((hashes[i] for i in misses), enc['length'])
+            )
+    
+    return counts, len(docs) - len(misses)
+
 def analyze_embedding_tokens(embedder):
-    # Get the tokenizer matching your sentence-transformer model
-    tokenizer = AutoTokenizer.from_pretrained('sentence-transformers/all-MiniLM-L6-v2')
+    # Let the Rust tokenizer fan batch calls out over all cores
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+    
+    def fetch_page(offset: int) -> List[str]:
+        return embedder.collection.get(include=['documents'], limit=PAGE_SIZE, offset=offset)['documents']
     
-    # Get all documents from ChromaDB
-    all_docs = embedder.collection.get()
+    total = embedder.collection.count()
+    token_counts = np.empty(total, dtype=np.int32)
+    cache_hits = 0
+    offset = 0
     
-    # Count tokens for each chunk
-    token_counts = [len(tokenizer.encode(doc)) for doc in all_docs['documents']]
+    # Page through ChromaDB, fetching the next page while the current one is tokenized
+    cache = open_token_cache()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        next_page = pool.submit(fetch_page, 0)
+        while offset < total:
+            docs = next_page.result()
+            if not docs:
+                break
+            next_page = pool.submit(fetch_page, offset + len(docs))
+            
+            counts, hits = count_tokens(docs, cache)
+            token_counts[offset:offset + len(counts)] = counts
+            cache_hits += hits
+            offset += len(docs)
+    cache.close()
     
-    # Calculate statistics
+    token_counts = token_counts[:offset]
+    print(f"Token count cache: {cache_hits:,} hits, {offset - cache_hits:,} misses")
+    
+    # Calculate statistics from the single int32 array
     stats = {
         'total_chunks': len(token_counts),
-        'total_tokens': sum(token_counts),
-        'avg_tokens_per_chunk': np.mean(token_counts),
-        'min_tokens': min(token_counts),
-        'max_tokens': max(token_counts),
-        'median_tokens': np.median(token_counts)
+        'total_tokens': int(token_counts.sum(dtype=np.int64)),
+        'avg_tokens_per_chunk': float(token_counts.mean()),
+        'min_tokens': int(token_counts.min()),
+        'max_tokens': int(token_counts.max()),
+        'median_tokens': float(np.median(token_counts))
     }
     
     print(f"Total chunks: {stats['total_chunks']:,}")
@@ -32,6 +119,10 @@ def analyze_embedding_tokens(embedder):
     
     return stats
 
-# Use it with your existing embedder
-embedder = ZoteroEmbedder(storage_path="~/Zotero/storage")
-stats = analyze_embedding_tokens(embedder)
\ No newline at end of file
+if __name__ == "__main__":
+    # Imported here so importing this module doesn't load torch and chromadb
+    from project import ZoteroEmbedder
+    
+    # Use it with your existing embedder
+    embedder = ZoteroEmbedder(storage_path="~/Zotero/storage")
+    stats = analyze_embedding_tokens(embedder)
\ No newline at end of file
@@ -1,17 +1,44 @@
-from semanticscholar import SemanticScholar
 from pyzotero import zotero
+import asyncio
+import contextlib
+import copy
+import httpx
 import os
 import sqlite3
 from pathlib import Path
 from dotenv import load_dotenv
 from tqdm import tqdm
-from typing import Dict, List, Optional
+from tqdm.asyncio import tqdm_asyncio
+from typing import Dict, List, Optional, Tuple
 import time
 from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
 import argparse
 
+ZOTERO_WRITE_BATCH_SIZE = 50  # Maximum items per Zotero write request
+LOCAL_FETCH_SIZE = 10000  # Rows pulled per fetch from the local database
+
+# One row per item that has a DOI, with its title joined alongside
+LOCAL_DOI_QUERY = """
+SELECT doiValues.value, COALESCE(titleValues.value, 'Unknown')
+FROM itemData AS doiData
+JOIN fields AS doiFields
+    ON doiData.fieldID = doiFields.fieldID AND doiFields.fieldName = 'DOI'
+JOIN itemDataValues AS doiValues ON doiData.valueID = doiValues.valueID
+LEFT JOIN itemData AS titleData
+    ON titleData.itemID = doiData.itemID
+    AND titleData.fieldID = (SELECT fieldID FROM fields WHERE fieldName = 'title')
+LEFT JOIN itemDataValues AS titleValues ON titleData.valueID = titleValues.valueID
+"""
+
+def author_to_creator(author: str) -> Dict[str, str]:
+    """Convert a 'First Middle Last' author name into a Zotero creator entry"""
+    first, _, last = author.rpartition(' ')
+    if first:
+        return {'creatorType': 'author', 'firstName': first, 'lastName': last}
+    return {'creatorType': 'author', 'lastName': author}
+
 class ZoteroAccessMode(Enum):
     LOCAL = "local"
     API = "api"
@@ -28,15 +55,54 @@ class ZoteroAccessor:
     def __init__(self, config: ZoteroConfig):
         self.config = config
         self.api_client = None
+        self._jarticle_tpl = None
+        self.conn = None
         self.db_path = os.path.join(os.path.expanduser(config.zotero_dir), 'zotero.sqlite')
         
         if not os.path.exists(self.db_path):
             raise ValueError(f"Zotero database not found: {self.db_path}")
+        
+        if config.mode in [ZoteroAccessMode.LOCAL, ZoteroAccessMode.BOTH]:
+            self.conn = self._connect_local()
             
         if config.mode in [ZoteroAccessMode.API, ZoteroAccessMode.BOTH]:
             if not config.library_id or not config.api_key:
                 raise ValueError("API mode requires library_id and api_key")
             self.api_client = zotero.Zotero(config.library_id, 'user', config.api_key)
+            self._jarticle_tpl = self.api_client.item_template('journalArticle')
+    
+    def _connect_local(self) -> sqlite3.Connection:
+        """Open a read-only connection to the local Zotero database tuned for scans"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+        conn.execute("PRAGMA cache_size = -65536")    # 64 MB
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+    
+    def ensure_doi_index(self):
+        """Add a covering index for the DOI scan to the local database (only run while Zotero is closed)"""
+        if self.conn is None:
+            raise ValueError("Creating the index requires local database access")
+        
+        self.conn.execute("PRAGMA query_only = OFF")
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS tryllm_itemData_field ON itemData(fieldID, itemID, valueID)"
+                )
+        finally:
+            self.conn.execute("PRAGMA query_only = ON")
+        
+        print("Query plan for local DOI scan:")
+        for row in self.conn.execute("EXPLAIN QUERY PLAN " + LOCAL_DOI_QUERY):
+            print(f"  {row[-1]}")
+    
+    def close(self):
+        """Close the local database connection if one is open"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
     
     def get_api_dois(self) -> Dict[str, Dict]:
         """Get DOIs and metadata from Zotero API"""
@@ -72,26 +138,14 @@ class ZoteroAccessor:
             return {}
             
         dois = {}
-        with sqlite3.connect(self.db_path) as conn:
-            query = """
-            SELECT fields.fieldName, itemDataValues.value, items.key, items.itemID
-            FROM itemData
-            JOIN itemDataValues ON itemData.valueID = itemDataValues.valueID
-            JOIN fields ON itemData.fieldID = fields.fieldID
-            JOIN items ON itemData.itemID = items.itemID
-            WHERE fields.fieldName IN ('DOI', 'title')
-            """
-            
-            items_data = defaultdict(dict)
-            
-            cursor = conn.execute(query)
-            for field_name, value, key, item_id in cursor:
-                items_data[item_id][field_name] = value
-            
-            for item_id, data in items_data.items():
-                if 'DOI' in data:
-                    dois[data['DOI'].lower()] = {
-                        'title': data.get('title', 'Unknown'),
+        with self.conn as conn:
+            # Read the whole scan in one transaction, pulling rows in large blocks
+            conn.execute("BEGIN DEFERRED")
+            cursor = conn.execute(LOCAL_DOI_QUERY)
+            while rows := cursor.fetchmany(LOCAL_FETCH_SIZE):
+                for doi, title in rows:
+                    dois[doi.lower()] = {
+                        'title': title,
                         'source': 'local'
                     }
         
@@ -116,74 +170,214 @@ class ZoteroAccessor:
         print(f"Total unique DOIs: {len(all_dois)}")
         return all_dois
     
-    def add_paper(self, paper: Dict):
-        """Add a paper to Zotero"""
+    def add_papers(self, papers: List[Dict]) -> Dict[str, str]:
+        """Add papers to Zotero in batched write requests, returning failures keyed by DOI"""
         if self.api_client is None:
             raise ValueError("Cannot add papers without API access")
+        
+        templates = []
+        for paper in papers:
+            template = copy.deepcopy(self._jarticle_tpl)
+            template['title'] = paper['title']
+            template['DOI'] = paper['doi']
+            template['date'] = str(paper['year']) if paper['year'] else ''
+            
+            # Add creators
+            template['creators'] = [author_to_creator(author) for author in paper['authors']]
             
-        template = self.api_client.item_template('journalArticle')
-        template['title'] = paper['title']
-        template['DOI'] = paper['doi']
-        template['date'] = str(paper['year']) if paper['year'] else ''
+            # Add note about source
+            template['notes'] = [{'note': f"Added via citation expansion from: {paper['source_paper']}"}]
+            templates.append(template)
         
-        # Add creators
-        template['creators'] = []
-        for author in paper['authors']:
-            parts = author.split(' ')
-            if len(parts) > 1:
-                template['creators'].append({
-                    'creatorType': 'author',
-                    'firstName': ' '.join(parts[:-1]),
-                    'lastName': parts[-1]
-                })
-            else:
-                template['creators'].append({
-                    'creatorType': 'author',
-                    'lastName': author
-                })
+        # Create the items, up to Zotero's per-request limit at a time
+        failed = {}
+        for i in range(0, len(templates), ZOTERO_WRITE_BATCH_SIZE):
+            batch = papers[i:i + ZOTERO_WRITE_BATCH_SIZE]
+            try:
+                response = self.api_client.create_items(templates[i:i + ZOTERO_WRITE_BATCH_SIZE])
+                for index, error in response.get('failed', {}).items():
+                    failed[batch[int(index)]['doi']] = error.get('message', str(error))
+            except Exception as e:
+                for paper in batch:
+                    failed[paper['doi']] = str(e)
+            time.sleep(0.5)  # Be nice to the Zotero API
         
-        # Add note about source
-        template['notes'] = [{'note': f"Added via citation expansion from: {paper['source_paper']}"}]
+        return failed
+
+SEMANTIC_API_BASE = "https://api.semanticscholar.org/graph/v1"
+CITING_PAPER_FIELDS = "title,year,authors,externalIds"
+CITATION_FIELDS = "citationCount," + ",".join(f"citations.{field}" for field in CITING_PAPER_FIELDS.split(","))
+# The batch endpoint takes up to 500 ids, but nested citation lists make responses huge, so ask for far fewer
+PAPER_BATCH_SIZE = 20
+CITATION_PAGE_SIZE = 1000  # Maximum citations per page from /paper/{id}/citations
+SEMANTIC_MAX_RETRIES = 5  # Attempts for rate-limited or failed Semantic Scholar requests
+
+class AsyncTokenBucket:
+    """Async rate limiter that only blocks once the bucket of request tokens is empty"""
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def __aenter__(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    async def __aexit__(self, *exc_info):
+        return False
+
+def parse_citing_paper(citing_paper: Dict, source_title: str) -> Optional[Dict]:
+    """Convert a Semantic Scholar paper record into our citation format, or None if it has no DOI"""
+    external_ids = citing_paper.get('externalIds') or {}
+    if not external_ids.get('DOI'):
+        return None
+    return {
+        'title': citing_paper.get('title') or 'Unknown Title',
+        'doi': external_ids['DOI'].lower(),
+        'year': citing_paper.get('year'),
+        'authors': [
+            author.get('name') or 'Unknown Author'
+            for author in citing_paper.get('authors') or []
+        ],
+        'source_paper': source_title
+    }
+
+async def semantic_request(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    limiter: "AsyncTokenBucket",
+    method: str,
+    url: str,
+    **kwargs
+) -> httpx.Response:
+    """Make a Semantic Scholar request, retrying rate limits, server errors and timeouts with backoff"""
+    for attempt in range(SEMANTIC_MAX_RETRIES):
+        try:
+            async with sem, limiter:
+                response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if attempt == SEMANTIC_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+            continue
         
-        # Create the item
-        self.api_client.create_items([template])
+        retryable = response.status_code == 429 or response.status_code >= 500
+        if not retryable or attempt == SEMANTIC_MAX_RETRIES - 1:
+            response.raise_for_status()
+            return response
+        # Honour the server's Retry-After when it sends one, otherwise back off exponentially
+        retry_after = response.headers.get('Retry-After', '')
+        await asyncio.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
 
-def collect_citation_dois(sch: SemanticScholar, source_doi: str, source_title: str, rate_limit: float) -> List[Dict]:
-    """Get citation information for a single paper"""
+async def collect_paged_citations(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    limiter: "AsyncTokenBucket",
+    doi: str
+) -> List[Dict]:
+    """Page through every citing paper of a DOI, for papers whose nested citation list was cut short"""
+    citing_papers = []
+    offset = 0
+    while offset is not None:
+        response = await semantic_request(
+            client, sem, limiter, "GET", f"/paper/DOI:{doi}/citations",
+            params={'fields': CITING_PAPER_FIELDS, 'offset': offset, 'limit': CITATION_PAGE_SIZE}
+        )
+        page = response.json()
+        citing_papers.extend(citation['citingPaper'] for citation in page.get('data') or [])
+        offset = page.get('next')
+    return citing_papers
+
+async def collect_citation_dois(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    limiter: "AsyncTokenBucket",
+    papers: List[Tuple[str, str]]
+) -> List[Tuple[str, List[Dict]]]:
+    """Get citation information for a batch of (DOI, title) papers in one request"""
     try:
-        paper = sch.get_paper(source_doi)
+        response = await semantic_request(
+            client, sem, limiter, "POST", "/paper/batch",
+            params={'fields': CITATION_FIELDS},
+            json={'ids': [f"DOI:{doi}" for doi, _ in papers]}
+        )
+    
+    except httpx.HTTPStatusError as e:
+        # A 400 here usually means the response would be too large, so retry each half separately
+        if e.response.status_code == 400 and len(papers) > 1:
+            half = len(papers) // 2
+            first, second = await asyncio.gather(
+                collect_citation_dois(client, sem, limiter, papers[:half]),
+                collect_citation_dois(client, sem, limiter, papers[half:])
+            )
+            return first + second
+        print(f"\nError processing DOI batch starting at {papers[0][0]}: {str(e)}")
+        return []
+    except Exception as e:
+        print(f"\nError processing DOI batch starting at {papers[0][0]}: {str(e)}")
+        return []
+    
+    # Results come back in request order, with null for DOIs Semantic Scholar doesn't know
+    results = []
+    for (doi, source_title), paper in zip(papers, response.json()):
         if not paper:
-            return []
-            
-        citations = sch.get_paper_citations(paper.paperId)
-        citation_data = []
+            continue
         
-        for citation in citations:
-            if hasattr(citation, '_data') and 'citingPaper' in citation._data:
-                citing_paper = citation._data['citingPaper']
-                if 'externalIds' in citing_paper and 'DOI' in citing_paper['externalIds']:
-                    citation_data.append({
-                        'title': citing_paper.get('title', 'Unknown Title'),
-                        'doi': citing_paper['externalIds']['DOI'].lower(),
-                        'year': citing_paper.get('year'),
-                        'authors': [
-                            author.get('name', 'Unknown Author') 
-                            for author in citing_paper.get('authors', [])
-                        ],
-                        'source_paper': source_title
-                    })
+        citing_papers = paper.get('citations') or []
+        if (paper.get('citationCount') or 0) > len(citing_papers):
+            # The nested list is capped per paper, so page through the full set instead
+            try:
+                citing_papers = await collect_paged_citations(client, sem, limiter, doi)
+            except Exception as e:
+                print(f"\nError paging citations for {source_title}, keeping the first {len(citing_papers)}: {str(e)}")
+        
+        citation_data = []
+        for citing_paper in citing_papers:
+            parsed = parse_citing_paper(citing_paper, source_title)
+            if parsed:
+                citation_data.append(parsed)
         
         if citation_data:
             print(f"Found {len(citation_data)} citations with DOIs for {source_title}")
-            
-        if rate_limit > 0:
-            time.sleep(rate_limit)
-            
-        return citation_data
+        results.append((source_title, citation_data))
     
-    except Exception as e:
-        print(f"\nError processing DOI {source_doi}: {str(e)}")
-        return []
+    return results
+
+async def collect_all_citations(
+    papers: Dict[str, Dict],
+    api_key: Optional[str],
+    rate_limit: float,
+    max_concurrency: int
+) -> List[Tuple[str, List[Dict]]]:
+    """Fetch citations for all papers concurrently as (source title, citations) pairs"""
+    headers = {'x-api-key': api_key} if api_key else {}
+    sem = asyncio.Semaphore(max_concurrency)
+    limiter = AsyncTokenBucket(1 / rate_limit) if rate_limit > 0 else contextlib.nullcontext()
+    
+    items = [(doi, paper_info['title']) for doi, paper_info in papers.items()]
+    async with httpx.AsyncClient(base_url=SEMANTIC_API_BASE, headers=headers, timeout=120) as client:
+        tasks = [
+            collect_citation_dois(client, sem, limiter, items[i:i + PAPER_BATCH_SIZE])
+            for i in range(0, len(items), PAPER_BATCH_SIZE)
+        ]
+        batches = await tqdm_asyncio.gather(*tasks, desc="Processing paper batches")
+    
+    return [result for batch in batches for result in batch]
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description='Expand Zotero library with citations')
@@ -194,6 +388,9 @@ def main():
     parser.add_argument('--zotero-dir',
                        default='~/Zotero',
                        help='Path to Zotero directory containing zotero.sqlite')
+    parser.add_argument('--create-index',
+                       action='store_true',
+                       help='Add a covering index for the DOI scan to zotero.sqlite (close Zotero first)')
     parser.add_argument('--batch-size',
                        type=int,
                        default=50,
@@ -201,15 +398,18 @@ def main():
     parser.add_argument('--rate-limit',
                        type=float,
                        default=1.1,
-                       help='Time to wait between Semantic Scholar API calls (in seconds)')
+                       help='Average time between Semantic Scholar API calls (in seconds), 0 to disable')
+    parser.add_argument('--max-concurrency',
+                       type=positive_int,
+                       default=10,
+                       help='Maximum number of concurrent Semantic Scholar API calls')
     args = parser.parse_args()
     
     # Load environment variables
     load_dotenv()
     
-    # Initialize Semantic Scholar client with API key if available
+    # Use the Semantic Scholar API key if available
     semantic_api_key = os.getenv('SEMANTIC_API_KEY')
-    sch = SemanticScholar(api_key=semantic_api_key) if semantic_api_key else SemanticScholar()
     
     # Get Zotero credentials if needed
     mode = ZoteroAccessMode(args.mode)
@@ -229,6 +429,8 @@ def main():
     )
     
     zotero = ZoteroAccessor(config)
+    if args.create_index:
+        zotero.ensure_doi_index()
     
     # Get existing DOIs
     existing_papers = zotero.get_all_dois()
@@ -236,30 +438,24 @@ def main():
     
     # Collect citations
     print("\nCollecting citations...")
-    new_papers = []
-    citation_sources = defaultdict(list)
+    results = asyncio.run(collect_all_citations(
+        existing_papers,
+        semantic_api_key,
+        args.rate_limit,
+        args.max_concurrency
+    ))
     
-        # In main(), update the citation collection loop:
-    for doi, paper_info in tqdm(existing_papers.items(), desc="Processing papers"):
-        print(f"\nProcessing: {paper_info['title']} (DOI: {doi})")
-        try:
-            citations = collect_citation_dois(sch, doi, paper_info['title'], args.rate_limit)
-            if citations:
-                print(f"Found {len(citations)} citations")
-            for citation in citations:
-                if citation['doi'] not in existing_dois:
-                    new_papers.append(citation)
-                    citation_sources[citation['doi']].append(paper_info['title'])
-        except Exception as e:
-            print(f"Failed to process {doi}: {str(e)}")
-            continue
+    # Work out which cited DOIs are new with a single set difference
+    new_dois = {citation['doi'] for _, citations in results for citation in citations} - existing_dois
     
-    # Remove duplicates while preserving source information
+    # Keep the first record for each new DOI along with every paper that cited it
     unique_papers = {}
-    for paper in new_papers:
-        doi = paper['doi']
-        if doi not in unique_papers:
-            unique_papers[doi] = paper
+    citation_sources = defaultdict(list)
+    for source_title, citations in results:
+        for citation in citations:
+            if citation['doi'] in new_dois:
+                unique_papers.setdefault(citation['doi'], citation)
+                citation_sources[citation['doi']].append(source_title)
     
     print(f"\nFound {len(unique_papers)} new papers to add")
     
@@ -278,17 +474,16 @@ def main():
         if mode != ZoteroAccessMode.LOCAL:
             response = input("\nAdd these papers to Zotero? [y/N]: ")
             if response.lower() == 'y':
-                for paper in tqdm(batch, desc="Adding to Zotero"):
-                    try:
-                        zotero.add_paper(paper)
-                        time.sleep(0.5)  # Be nice to the Zotero API
-                    except Exception as e:
-                        print(f"\nError adding paper {paper['doi']}: {str(e)}")
+                failed = zotero.add_papers(batch)
+                for doi, error in failed.items():
+                    print(f"\nError adding paper {doi}: {error}")
+                print(f"Added {len(batch) - len(failed)} of {len(batch)} papers")
             else:
                 print("Skipping batch.")
         else:
             print("\nRunning in local-only mode. Cannot add papers to Zotero without API access.")
     
+    zotero.close()
     print("\nOperation complete!")
 
 if __name__ == "__main__":
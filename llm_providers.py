@@ -1,61 +1,219 @@
 from abc import ABC, abstractmethod
+from functools import lru_cache
+import asyncio
+import importlib.util
 import os
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, AsyncIterator, Optional, Tuple
 import anthropic
 import openai
+import httpx
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 
+# Connection pool shared by the SDK clients and DeepSeek's async calls, so calls reuse open TLS connections.
+# HTTP/2 multiplexing needs the optional h2 package (pip install httpx[http2])
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+HTTP2 = importlib.util.find_spec("h2") is not None
+# The SDKs adopt a custom client's timeout, so match their 10 minute default; long non-streamed answers need it.
+# Override with LLM_HTTP_TIMEOUT (seconds)
+HTTP_TIMEOUT = httpx.Timeout(float(os.getenv('LLM_HTTP_TIMEOUT', 600)), connect=5.0)
+
+@lru_cache(maxsize=None)
+def shared_http_client() -> httpx.Client:
+    return httpx.Client(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+@lru_cache(maxsize=None)
+def shared_async_http_client() -> httpx.AsyncClient:
+    # Async connections belong to the event loop that opened them, so only use this from one asyncio.run
+    return httpx.AsyncClient(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+def _iter_stream_content(lines, usage: Dict[str, Any]) -> Iterator[str]:
+    """Yield the text deltas from an OpenAI-style chat completions event stream, filling usage from its last chunk"""
+    for line in lines:
+        if not line or not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            break
+        chunk = json.loads(data)
+        # With include_usage the final chunk carries the usage and no choices
+        if chunk.get("usage"):
+            usage.update(chunk["usage"])
+        for choice in chunk.get("choices") or []:
+            content = choice["delta"].get("content")
+            if content:
+                yield content
+
+def _flatten_content(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Join content blocks into plain strings for APIs that only take string content"""
+    return [
+        {**msg, "content": "".join(block["text"] for block in msg["content"])}
+        if isinstance(msg["content"], list) else msg
+        for msg in messages
+    ]
+
 class LLMProvider(ABC):
+    # Token usage reported for the most recent completed call
+    last_usage: Dict[str, Any] = {}
+
     @abstractmethod
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
         """Generate response from LLM"""
         pass
 
+    async def agenerate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
+        """Generate response from LLM without blocking the event loop"""
+        return await asyncio.to_thread(self.generate, messages, max_tokens, temperature)
+
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> Iterator[str]:
+        """Generate response from LLM as a stream of text pieces"""
+        yield self.generate(messages, max_tokens, temperature)
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> AsyncIterator[str]:
+        """Generate response from LLM as an async stream of text pieces"""
+        yield await self.agenerate(messages, max_tokens, temperature)
+
+    def cached_prompt_tokens(self) -> Optional[int]:
+        """Prompt tokens the provider served from its prompt cache on the last call, if it reports them"""
+        return None
+
 class OpenAIProvider(LLMProvider):
     def __init__(self, model: str = "gpt-4"):
         self.model = model
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        if not openai.api_key:
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key:
             raise ValueError("Missing OPENAI_API_KEY in environment variables")
+        self.client = openai.OpenAI(api_key=api_key, http_client=shared_http_client())
+        self.async_client = openai.AsyncOpenAI(api_key=api_key, http_client=shared_async_http_client())
 
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
-        response = openai.ChatCompletion.create(
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=_flatten_content(messages),
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        self.last_usage = response.usage.model_dump()
+        return response.choices[0].message.content
+
+    async def agenerate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
+        response = await self.async_client.chat.completions.create(
             model=self.model,
-            messages=messages,
+            messages=_flatten_content(messages),
             temperature=temperature,
             max_tokens=max_tokens
         )
+        self.last_usage = response.usage.model_dump()
         return response.choices[0].message.content
 
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> Iterator[str]:
+        with self.client.chat.completions.create(
+            model=self.model,
+            messages=_flatten_content(messages),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        ) as stream:
+            for chunk in stream:
+                # The final chunk carries the usage and no choices
+                if chunk.usage:
+                    self.last_usage = chunk.usage.model_dump()
+                for choice in chunk.choices:
+                    if choice.delta.content:
+                        yield choice.delta.content
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> AsyncIterator[str]:
+        stream = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=_flatten_content(messages),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async with stream:
+            async for chunk in stream:
+                if chunk.usage:
+                    self.last_usage = chunk.usage.model_dump()
+                for choice in chunk.choices:
+                    if choice.delta.content:
+                        yield choice.delta.content
+
+    def cached_prompt_tokens(self) -> Optional[int]:
+        # OpenAI caches long prompt prefixes automatically
+        return (self.last_usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+
 class AnthropicProvider(LLMProvider):
     def __init__(self, model: str = "claude-3-5-sonnet-latest"):
         self.model = model
-        self.client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+        self.client = anthropic.Anthropic(
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            http_client=shared_http_client()
+        )
+        self.async_client = anthropic.AsyncAnthropic(
+            api_key=os.getenv('ANTHROPIC_API_KEY'),
+            http_client=shared_async_http_client()
+        )
         if not os.getenv('ANTHROPIC_API_KEY'):
             raise ValueError("Missing ANTHROPIC_API_KEY in environment variables")
 
-    def generate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
-        # Convert messages to Anthropic format
+    def _format_messages(self, messages: List[Dict[str, Any]]) -> Tuple[Any, List[Dict[str, Any]]]:
+        # Convert messages to Anthropic format, which takes the system prompt separately
+        system = anthropic.NOT_GIVEN
         formatted_messages = []
         for msg in messages:
             if msg["role"] == "system":
-                # Prepend system message to first user message
+                system = msg["content"]
                 continue
+            # Content blocks (e.g. with cache_control) pass through untouched
             formatted_messages.append({
                 "role": "assistant" if msg["role"] == "assistant" else "user",
                 "content": msg["content"]
             })
-        
+        return system, formatted_messages
+
+    def cached_prompt_tokens(self) -> Optional[int]:
+        return self.last_usage.get("cache_read_input_tokens")
+
+    def generate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
+        system, formatted_messages = self._format_messages(messages)
         response = self.client.messages.create(
             model=self.model,
+            system=system,
+            messages=formatted_messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        self.last_usage = response.usage.model_dump()
+        return response.content[0].text
+
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> Iterator[str]:
+        system, formatted_messages = self._format_messages(messages)
+        with self.client.messages.stream(
+            model=self.model,
+            system=system,
+            messages=formatted_messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        ) as stream:
+            yield from stream.text_stream
+            self.last_usage = stream.get_final_message().usage.model_dump()
+
+    async def agenerate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
+        system, formatted_messages = self._format_messages(messages)
+        response = await self.async_client.messages.create(
+            model=self.model,
+            system=system,
             messages=formatted_messages,
             max_tokens=max_tokens,
             temperature=temperature
         )
+        self.last_usage = response.usage.model_dump()
         return response.content[0].text
 
 class DeepseekProvider(LLMProvider):
@@ -65,44 +223,97 @@ class DeepseekProvider(LLMProvider):
         if not self.api_key:
             raise ValueError("Missing DEEPSEEK_API_KEY in environment variables")
         self.api_base = "https://api.deepseek.com/v1"  # Update this if needed
+        
+        # Reuse one keep-alive session so repeated calls skip the TCP/TLS handshake
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        self._session = requests.Session()
+        self._session.headers.update(headers)
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._headers = headers
 
     def generate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
-        response = requests.post(
+        response = self._session.post(
             f"{self.api_base}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
+            json={
+                "model": self.model,
+                "messages": _flatten_content(messages),
+                "max_tokens": max_tokens,
+                "temperature": temperature
+            }
+        )
+        response.raise_for_status()
+        body = response.json()
+        self.last_usage = body.get("usage", {})
+        return body["choices"][0]["message"]["content"]
+
+    def generate_stream(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> Iterator[str]:
+        with self._session.post(
+            f"{self.api_base}/chat/completions",
+            json={
+                "model": self.model,
+                "messages": _flatten_content(messages),
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": True,
+                "stream_options": {"include_usage": True}
             },
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            usage = {}
+            yield from _iter_stream_content(response.iter_lines(decode_unicode=True), usage)
+            self.last_usage = usage
+
+    async def agenerate(self, messages: List[Dict[str, str]], max_tokens: int = 1000, temperature: float = 0.7) -> str:
+        response = await shared_async_http_client().post(
+            f"{self.api_base}/chat/completions",
+            headers=self._headers,
             json={
                 "model": self.model,
-                "messages": messages,
+                "messages": _flatten_content(messages),
                 "max_tokens": max_tokens,
                 "temperature": temperature
             }
         )
         response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+        body = response.json()
+        self.last_usage = body.get("usage", {})
+        return body["choices"][0]["message"]["content"]
+
+    def cached_prompt_tokens(self) -> Optional[int]:
+        # DeepSeek caches repeated prompt prefixes on disk automatically
+        return self.last_usage.get("prompt_cache_hit_tokens")
 
 # Model configurations
 MODEL_CONFIGS = {
     "gpt-4": {
         "provider": OpenAIProvider,
         "args": {"model": "gpt-4"},
+        "tokenizer": "Xenova/gpt-4",
         "description": "OpenAI GPT-4"
     },
     "gpt-3.5-turbo": {
         "provider": OpenAIProvider,
         "args": {"model": "gpt-3.5-turbo"},
+        "tokenizer": "Xenova/gpt-3.5-turbo",
         "description": "OpenAI GPT-3.5 Turbo"
     },
     "claude-sonnet": {
         "provider": AnthropicProvider,
         "args": {"model": "claude-3-5-sonnet-latest"},
+        "tokenizer": "Xenova/claude-tokenizer",  # Anthropic doesn't publish its current tokenizer; close enough for budgets
         "description": "Anthropic Claude 3.5 Sonnet"
     },
     "deepseek-r1": {
         "provider": DeepseekProvider,
         "args": {"model": "deepseek-chat"},
+        "tokenizer": "deepseek-ai/DeepSeek-V3",
         "description": "DeepSeek Chat R1"
     }
-}
\ No newline at end of file
+}
+
+# Computed once for CLI choices and error messages
+MODEL_NAMES = tuple(MODEL_CONFIGS)
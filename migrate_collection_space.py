@@ -0,0 +1,58 @@
+import argparse
+import chromadb
+import numpy as np
+from tqdm import tqdm
+
+COLLECTION_NAME = "zotero_papers"
+PAGE_SIZE = 5000
+
+def migrate(persist_directory: str):
+    """Copy the collection into an inner-product collection with unit-length vectors, then swap it in"""
+    client = chromadb.PersistentClient(path=persist_directory)
+    old = client.get_collection(COLLECTION_NAME)
+
+    if (old.metadata or {}).get("hnsw:space") == "ip":
+        print(f"'{COLLECTION_NAME}' already uses inner-product space, nothing to do")
+        return
+
+    # Start from a clean target in case an earlier migration was interrupted
+    tmp_name = f"{COLLECTION_NAME}_ip"
+    if tmp_name in client.list_collections():
+        client.delete_collection(tmp_name)
+    new = client.create_collection(tmp_name, metadata={"hnsw:space": "ip"})
+
+    total = old.count()
+    with tqdm(total=total, desc="Migrating chunks") as pbar:
+        for offset in range(0, total, PAGE_SIZE):
+            page = old.get(
+                limit=PAGE_SIZE,
+                offset=offset,
+                include=["embeddings", "documents", "metadatas"]
+            )
+            embeddings = np.asarray(page['embeddings'], dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.maximum(norms, 1e-12)  # Leave zero vectors (empty chunks) as zeros
+
+            new.add(
+                ids=page['ids'],
+                embeddings=embeddings,
+                documents=page['documents'],
+                metadatas=page['metadatas']
+            )
+            pbar.update(len(page['ids']))
+
+    client.delete_collection(COLLECTION_NAME)
+    new.modify(name=COLLECTION_NAME)
+    print(f"Migrated {total} chunks to inner-product space")
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate the embedding collection to inner-product space')
+    parser.add_argument('--persist-directory',
+                       default='chroma_db',
+                       help='Directory holding the Chroma database')
+
+    args = parser.parse_args()
+    migrate(args.persist_directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import fitz
+import hashlib
+from typing import Optional, Tuple
+
+# Kept free of torch/chromadb imports: extraction workers are spawned, and each one re-imports
+# the module its target lives in (plus the launching script, which must keep heavy imports lazy)
+
+# Plain-text extraction: expand ligatures and rejoin hyphenated line breaks; the default
+# whitespace/clip flags stay and images are never decoded
+PDF_TEXT_FLAGS = (fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES) | fitz.TEXT_DEHYPHENATE
+
+def read_pages(doc, max_chars: Optional[int] = None) -> str:
+    """Join the text of an open PDF's pages, stopping early once max_chars have been read"""
+    parts = []
+    n_chars = 0
+    for page in doc:
+        page_text = page.get_text("text", flags=PDF_TEXT_FLAGS, sort=False)
+        parts.append(page_text)
+        n_chars += len(page_text)
+        if max_chars is not None and n_chars >= max_chars:
+            break
+    return "".join(parts)
+
+def extract_pdf_text(pdf_path: str, max_chars: Optional[int] = None) -> str:
+    """Extract a PDF's text, stopping early once max_chars have been read"""
+    with fitz.open(pdf_path) as doc:
+        return read_pages(doc, max_chars)
+
+def extract_pdf(pdf_path: str) -> Tuple[str, str]:
+    """Read a PDF once and return its text and sha1"""
+    with open(pdf_path, "rb") as f:
+        data = f.read()
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        return read_pages(doc), hashlib.sha1(data).hexdigest()
@@ -1,9 +1,18 @@
 from pyzotero import zotero
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, CrossEncoder, export_dynamic_quantized_onnx_model
 import torch
-from typing import List, Dict
-import fitz  # Change this line back
+import numpy as np
+from typing import List, Dict, Optional, Tuple
+from functools import lru_cache
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import os
+import itertools
+import multiprocessing
+import mmap
+import sqlite3
+import threading
+import time
 from tqdm import tqdm
 import chromadb
 import uuid
@@ -11,56 +20,113 @@ import json
 from dotenv import load_dotenv
 import glob
 import toml
+from response_cache import INGEST_MARKER
+from pdf_text import extract_pdf, extract_pdf_text
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Portable int8 quantization for the ONNX backend, and the file it is exported to
+ONNX_QUANTIZATION_CONFIG = "avx2"
+ONNX_QUANTIZED_FILE = f"onnx/model_qint8_{ONNX_QUANTIZATION_CONFIG}.onnx"
+
+# Concurrent Zotero API requests, and retries when the API rate-limits us
+ZOTERO_WORKERS = 8
+ZOTERO_MAX_RETRIES = 5
+
+# PDFs queued per extraction worker process at any one time
+EXTRACT_IN_FLIGHT_PER_WORKER = 2
+
+# Cached listing of PDFs in Zotero storage, and the storage folder mtime it was taken at
+PDF_LISTING_FILE = ".pdf_manifest"
+STORAGE_MTIME_FILE = ".storage_mtime"
+
+# Per-paper metadata, stored once per paper in the manifest rather than on every chunk
+PAPER_FIELDS = ('title', 'authors', 'year', 'doi', 'tags')
+
+# Cross-encoder that reorders the nearest chunks, and how many candidates it sees per result kept
+RERANKER_MODEL = 'BAAI/bge-reranker-base'
+RERANK_CANDIDATES = 20
+
+@lru_cache(maxsize=None)
+def get_reranker(device: str) -> CrossEncoder:
+    """Load the cross-encoder on first use, so plain searches never pay for it"""
+    return CrossEncoder(RERANKER_MODEL, device=device)
+
 class CustomEmbeddingFunction:
-    def __init__(self, model, device):
+    def __init__(self, model, device, batch_size: int = 32):
         self.model = model
         self.device = device
+        self.batch_size = batch_size
 
-    def __call__(self, input: List[str]) -> List[List[float]]:
-        # Filter out empty texts and keep track of their positions
-        valid_texts = []
-        valid_indices = []
-        for i, text in enumerate(input):
-            if text and len(text.strip()) > 0:
-                valid_texts.append(text)
-                valid_indices.append(i)
-
-        if not valid_texts:
-            # If no valid texts, return zero vectors
-            embedding_dim = 384  # This is the dimension for 'all-MiniLM-L6-v2'
-            return [[0.0] * embedding_dim] * len(input)
-
-        # Get embeddings for valid texts
-        with torch.no_grad():
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts directly into a contiguous float32 array of unit-length vectors"""
+        with torch.inference_mode():
             embeddings = self.model.encode(
-                valid_texts,
-                convert_to_tensor=True,
+                texts,
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
                 device=self.device
             )
-            embeddings = embeddings.cpu().numpy()
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
 
-        # Create result array with zero vectors for invalid texts
-        result = [[0.0] * embeddings.shape[1]] * len(input)
-        
-        # Put valid embeddings back in their original positions
-        for i, orig_idx in enumerate(valid_indices):
-            result[orig_idx] = embeddings[i].tolist()
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        # Filter out empty texts and keep track of their positions
+        valid = [(i, text) for i, text in enumerate(input) if text and text.strip()]
+
+        # Empty texts get zero vectors
+        result = np.zeros((len(input), self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        if valid:
+            valid_indices, valid_texts = zip(*valid)
+            result[np.asarray(valid_indices, dtype=np.int64)] = self.encode(list(valid_texts))
+
+        return result.tolist()
 
-        return result
+@dataclass
+class _PendingBatch:
+    """Chunks accumulated across PDFs, waiting to be embedded and added to ChromaDB"""
+    documents: List[str] = field(default_factory=list)
+    ids: List[str] = field(default_factory=list)
+    metadatas: List[Dict] = field(default_factory=list)
+    # Manifest and paper metadata rows for the items whose chunks are in this batch
+    manifest_rows: List[Tuple] = field(default_factory=list)
+    paper_rows: List[Tuple] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def extend(self, documents: List[str], ids: List[str], metadatas: List[Dict]):
+        self.documents.extend(documents)
+        self.ids.extend(ids)
+        self.metadatas.extend(metadatas)
+
+    def clear(self):
+        self.documents.clear()
+        self.ids.clear()
+        self.metadatas.clear()
+        self.manifest_rows.clear()
+        self.paper_rows.clear()
 
 class ZoteroEmbedder:
-    def __init__(self, storage_path: str, persist_directory: str = "chroma_db"):
+    def __init__(self, storage_path: str, persist_directory: str = "chroma_db", precision: str = "auto", backend: str = "torch"):
         """
         Initialize the ZoteroEmbedder
         
         Args:
             storage_path: Path to local Zotero storage (e.g., '~/Zotero/storage')
             persist_directory: Directory to store the Chroma database
+            precision: "auto" for fp16 on CUDA, bf16 on MPS and int8 dynamic quantization on CPU,
+                or "fp32" to keep full precision
+            backend: "torch", or "onnx" to run an int8-quantized ONNX export with ONNX Runtime when
+                on CPU (requires sentence-transformers[onnx])
         """
+        if precision not in ("auto", "fp32"):
+            raise ValueError(f"Unknown precision: {precision}. Use 'auto' or 'fp32'")
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unknown backend: {backend}. Use 'torch' or 'onnx'")
+
         # Get credentials from environment variables
         library_id = os.getenv('LIBRARY_ID')
         api_key = os.getenv('API_KEY')
@@ -69,6 +135,9 @@ class ZoteroEmbedder:
             raise ValueError("Missing LIBRARY_ID or API_KEY in environment variables")
         
         self.zot = zotero.Zotero(library_id, 'user', api_key)
+        # pyzotero clients keep per-request state, so worker threads each get their own
+        self._zot_args = (library_id, 'user', api_key)
+        self._zot_local = threading.local()
         
         # Expand and verify storage path
         self.storage_path = os.path.expanduser(storage_path)
@@ -87,55 +156,314 @@ class ZoteroEmbedder:
         )
         print(f"Using device: {self.device}")
         
+        # ONNX Runtime only pays off on CPU; keep PyTorch for MPS/CUDA
+        if backend == "onnx" and self.device != "cpu":
+            print(f"ONNX backend is CPU-only, using PyTorch on {self.device}")
+            backend = "torch"
+        self.backend = backend
+        
         # Initialize the model with the appropriate device
         self.model_name = 'all-MiniLM-L6-v2'
-        self.model = SentenceTransformer(self.model_name)
-        self.model.to(self.device)
+        if self.backend == "onnx":
+            self.model = self._load_onnx_model(persist_directory)
+        else:
+            self.model = SentenceTransformer(self.model_name)
+            self.model.to(self.device)
+            
+            # Reduce precision to cut memory traffic and use faster matmul paths
+            if precision == "auto":
+                if self.device == "cuda":
+                    self.model.half()
+                elif self.device == "mps":
+                    self.model.to(torch.bfloat16)
+                else:
+                    self.model = torch.quantization.quantize_dynamic(
+                        self.model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+            
+            # Compile the underlying transformer in place; encode() calls it as a module so it picks this up
+            if self.device == "cuda":
+                try:
+                    self.model[0].auto_model.compile(mode="reduce-overhead")
+                except Exception as e:
+                    print(f"torch.compile unavailable, running eagerly: {str(e)}")
+        
+        self.tokenizer = self.model.tokenizer
         
         # Initialize ChromaDB with custom embedding function
+        self.persist_directory = persist_directory
         self.chroma_client = chromadb.PersistentClient(path=persist_directory)
         self.embedding_function = CustomEmbeddingFunction(self.model, self.device)
         
+        # Warm up the model (and any compiled kernels) before real batches arrive
+        self.embedding_function(["warmup"] * 8)
+        
+        # ChromaDB caps how many records a single add can carry
+        self._max_add_batch = self.chroma_client.get_max_batch_size()
+        
+        # Bumped whenever the collection changes, so callers can invalidate cached lookups
+        self.generation = 0
+        
+        # PDFs in storage grouped by attachment folder, loaded on first use
+        self._storage_pdfs = None
+        self._storage_lock = threading.Lock()
+        
+        # Manifest of what has been embedded, so unchanged items can be skipped on re-runs
+        self._manifest = self._open_manifest(persist_directory)
+        self._papers = {
+            row[0]: dict(zip(PAPER_FIELDS, row[1:]))
+            for row in self._manifest.execute(f"SELECT zotero_key, {', '.join(PAPER_FIELDS)} FROM papers")
+        }
+        
         # Create or get collection
+        # Embeddings are unit-length, so inner product is cosine similarity without renormalizing
         self.collection = self.chroma_client.get_or_create_collection(
             name="zotero_papers",
-            embedding_function=self.embedding_function
+            embedding_function=self.embedding_function,
+            metadata={"hnsw:space": "ip"}
         )
+        # Collections created before the switch to inner product keep their original space
+        self.space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        if self.space == "l2":
+            print("Warning: collection uses L2 distance; run migrate_collection_space.py to switch to inner product")
 
-    def get_pdf_content(self, item) -> str:
+    def _open_manifest(self, persist_directory: str) -> sqlite3.Connection:
+        """Open (creating if needed) the SQLite manifest of embedded items next to the Chroma database"""
+        conn = sqlite3.connect(os.path.join(persist_directory, "manifest.sqlite"))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS manifest (
+                zotero_key TEXT PRIMARY KEY,
+                zot_version INTEGER,
+                pdf_path TEXT,
+                pdf_mtime REAL,
+                sha1 TEXT,
+                empty INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # Manifests from before PDFs without text were recorded lack the flag (1 = no chunks to embed)
+        if "empty" not in {row[1] for row in conn.execute("PRAGMA table_info(manifest)")}:
+            conn.execute("ALTER TABLE manifest ADD COLUMN empty INTEGER NOT NULL DEFAULT 0")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS papers (
+                zotero_key TEXT PRIMARY KEY,
+                title TEXT,
+                authors TEXT,
+                year TEXT,
+                doi TEXT,
+                tags TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS storage_snapshot (
+                pdf_path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER
+            )
+        """)
+        conn.commit()
+        return conn
+
+    def _walk_storage(self) -> List[str]:
+        """List every PDF in Zotero storage, one level of attachment folders deep"""
+        pdfs = []
+        with os.scandir(self.storage_path) as folders:
+            for folder in folders:
+                if not folder.is_dir():
+                    continue
+                with os.scandir(folder.path) as files:
+                    pdfs.extend(f.path for f in files if f.name.lower().endswith('.pdf'))
+        return pdfs
+
+    def _list_storage_pdfs(self, refresh: bool = False) -> List[str]:
         """
-        Retrieve PDF content from local storage
+        List every PDF in Zotero storage, reusing the listing cached in the persist directory until the
+        storage folder's mtime changes (adding or removing an attachment folder updates it)
+        """
+        listing_path = os.path.join(self.persist_directory, PDF_LISTING_FILE)
+        mtime_path = os.path.join(self.persist_directory, STORAGE_MTIME_FILE)
+        storage_mtime = str(os.stat(self.storage_path).st_mtime_ns)
+        
+        if not refresh:
+            try:
+                with open(mtime_path) as f:
+                    fresh = f.read() == storage_mtime
+                if fresh:
+                    with open(listing_path, 'rb') as f:
+                        if os.fstat(f.fileno()).st_size == 0:
+                            return []
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as listing:
+                            return [os.fsdecode(path) for path in listing.read().split(b'\n') if path]
+            except FileNotFoundError:
+                pass
+        
+        pdfs = self._walk_storage()
+        # Write to temporary files and rename, so a crash never leaves a half-written listing behind;
+        # the mtime goes last so it only ever vouches for a complete listing
+        for path, data in (
+            (listing_path, b'\n'.join(os.fsencode(pdf) for pdf in pdfs)),
+            (mtime_path, storage_mtime.encode())
+        ):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        return pdfs
+
+    def _pdfs_by_folder(self) -> Dict[str, List[str]]:
+        """PDFs in storage keyed by their attachment folder (the attachment's Zotero key)"""
+        with self._storage_lock:
+            if self._storage_pdfs is None:
+                self._storage_pdfs = {}
+                for pdf in self._list_storage_pdfs():
+                    self._storage_pdfs.setdefault(os.path.basename(os.path.dirname(pdf)), []).append(pdf)
+            return self._storage_pdfs
+
+    def _scan_storage(self) -> Dict[str, Tuple[float, int]]:
+        """Map every PDF in Zotero storage to its (mtime, size)"""
+        pdfs = {}
+        for refresh in (False, True):
+            try:
+                for path in self._list_storage_pdfs(refresh):
+                    st = os.stat(path)
+                    pdfs[path] = (st.st_mtime, st.st_size)
+                return pdfs
+            except FileNotFoundError:
+                # A listed PDF was renamed or deleted inside its folder, so the cached listing is stale
+                pdfs.clear()
+                self._storage_pdfs = None
+        raise RuntimeError(f"Zotero storage kept changing while scanning {self.storage_path}")
+
+    def is_up_to_date(self) -> bool:
+        """Whether the collection is populated and no PDF in storage was added, removed or changed since the last ingest"""
+        if self.collection.count() == 0:
+            return False
+        snapshot = {
+            path: (mtime, size)
+            for path, mtime, size in self._manifest.execute("SELECT pdf_path, mtime, size FROM storage_snapshot")
+        }
+        return bool(snapshot) and snapshot == self._scan_storage()
+
+    def _load_onnx_model(self, persist_directory: str) -> SentenceTransformer:
+        """Load the int8-quantized ONNX model, exporting it into persist_directory on first use"""
+        onnx_dir = os.path.join(persist_directory, "onnx_model")
+        if not os.path.exists(os.path.join(onnx_dir, ONNX_QUANTIZED_FILE)):
+            print(f"Exporting {self.model_name} to ONNX in {onnx_dir}...")
+            model = SentenceTransformer(self.model_name, backend="onnx")
+            model.save(onnx_dir)
+            export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION_CONFIG, onnx_dir)
+        
+        return SentenceTransformer(
+            onnx_dir,
+            backend="onnx",
+            model_kwargs={"file_name": ONNX_QUANTIZED_FILE}
+        )
+
+    def _zotero_call(self, method: str, *args, **kwargs):
+        """Call a Zotero API method on this thread's client, retrying when rate-limited"""
+        zot = getattr(self._zot_local, 'zot', None)
+        if zot is None:
+            zot = self._zot_local.zot = zotero.Zotero(*self._zot_args)
+        
+        for attempt in range(ZOTERO_MAX_RETRIES):
+            try:
+                return getattr(zot, method)(*args, **kwargs)
+            except Exception:
+                rate_limited = zot.request is not None and zot.request.status_code == 429
+                if not rate_limited or attempt == ZOTERO_MAX_RETRIES - 1:
+                    raise
+            # pyzotero waits out a Retry-After it received before the next call; otherwise back off ourselves
+            if not zot.backoff:
+                time.sleep(2 ** attempt)
+
+    def find_pdf_path(self, item) -> Optional[str]:
+        """
+        Find the first PDF attached to an item in local storage
         """
         try:
             # Get child attachments
-            children = self.zot.children(item['key'])
+            children = self._zotero_call('children', item['key'])
             
             # Find PDF attachment
             for child in children:
                 if child['data'].get('contentType') == 'application/pdf':
-                    pdf_key = child['key']
                     # Check the storage folder for PDFs
-                    folder_path = os.path.join(self.storage_path, pdf_key)
-                    if os.path.exists(folder_path):
-                        # Get all PDFs in this folder
-                        pdfs = glob.glob(os.path.join(folder_path, "*.pdf"))
-                        if pdfs:
-                            try:
-                                # Use the first PDF found
-                                doc = fitz.open(pdfs[0])
-                                text = ""
-                                for page in doc:
-                                    text += page.get_text()
-                                doc.close()
-                                return text
-                            except Exception as e:
-                                print(f"Error reading PDF for {item['data'].get('title', 'Unknown')}: {str(e)}")
+                    pdfs = self._pdfs_by_folder().get(child['key'])
+                    if pdfs:
+                        return pdfs[0]
                         
-            return ""  # Return empty string if no PDF found
+            return None
         except Exception as e:
             print(f"Error accessing children for {item['data'].get('title', 'Unknown')}: {str(e)}")
+            return None
+
+    def get_pdf_content(self, item, max_chars: Optional[int] = None) -> str:
+        """
+        Retrieve PDF content from local storage, stopping early once max_chars have been read
+        """
+        pdf_path = self.find_pdf_path(item)
+        if pdf_path is None:
+            return ""  # Return empty string if no PDF found
+        try:
+            return extract_pdf_text(pdf_path, max_chars)
+        except Exception as e:
+            print(f"Error reading PDF for {item['data'].get('title', 'Unknown')}: {str(e)}")
             return ""
 
+    def _item_metadata(self, item) -> Dict:
+        """Build the paper-level metadata for an item"""
+        # Convert authors to string format
+        author_strings = []
+        for author in item['data'].get('creators', []):
+            if 'firstName' in author and 'lastName' in author:
+                author_strings.append(f"{author['firstName']} {author['lastName']}")
+            elif 'lastName' in author:
+                author_strings.append(author['lastName'])
+        
+        return {
+            'title': item['data'].get('title', ''),
+            'authors': '; '.join(author_strings),
+            'year': item['data'].get('date', ''),
+            'doi': item['data'].get('DOI', ''),
+            'tags': ', '.join([tag.get('tag', '') for tag in item['data'].get('tags', [])])
+        }
+
+    def paper_metadata(self, chunk_metadata: Dict) -> Dict:
+        """Join a chunk's metadata with the metadata of the paper it came from"""
+        # Chunks embedded before paper metadata moved to the manifest carry it themselves
+        paper = self._papers.get(chunk_metadata['zotero_key'], dict.fromkeys(PAPER_FIELDS, ''))
+        return {**paper, **chunk_metadata}
+
+    def get_papers(self, titles: List[str]) -> Dict[str, Tuple[List[str], Dict]]:
+        """Get the chunks, in order, and metadata of several papers by title in a single query"""
+        wanted = set(titles)
+        keys = [key for key, paper in self._papers.items() if paper['title'] in wanted]
+        # Older collections only have titles on the chunks themselves
+        unindexed = list(wanted - {self._papers[key]['title'] for key in keys})
+        clauses = []
+        if keys:
+            clauses.append({"zotero_key": {"$in": keys}})
+        if unindexed:
+            clauses.append({"title": {"$in": unindexed}})
+        if not clauses:
+            return {}
+        where = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+        results = self.collection.get(where=where, include=["documents", "metadatas"])
+        
+        by_title = {}
+        chunks = sorted(
+            zip(results['metadatas'], results['documents']),
+            key=lambda c: (c[0]['zotero_key'], c[0].get('chunk_index', 0))
+        )
+        for chunk_metadata, document in chunks:
+            metadata = self.paper_metadata(chunk_metadata)
+            by_title.setdefault(metadata['title'], ([], metadata))[0].append(document)
+        # Keep the caller's order
+        return {title: by_title[title] for title in titles if title in by_title}
+
+    def get_paper(self, title: str) -> Optional[Tuple[List[str], Dict]]:
+        """Get a paper's chunks, in order, and its metadata by title"""
+        return self.get_papers([title]).get(title)
+
     def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
         """Split text into overlapping chunks"""
         if not text or len(text.strip()) == 0:
@@ -154,148 +482,341 @@ class ZoteroEmbedder:
             
         return chunks
 
-    def create_embeddings(self, chunk_size: int = 1000, overlap: int = 100, batch_size: int = 32, update_mode: str = "new_only"):
+    def _flush(self, pending: _PendingBatch):
+        """Embed all pending chunks and add them to ChromaDB, split only as far as ChromaDB requires"""
+        try:
+            for i in range(0, len(pending), self._max_add_batch):
+                documents = pending.documents[i:i + self._max_add_batch]
+                # Pass precomputed vectors so ChromaDB doesn't call the embedding function itself
+                self.collection.add(
+                    documents=documents,
+                    embeddings=self.embedding_function.encode(documents),
+                    ids=pending.ids[i:i + self._max_add_batch],
+                    metadatas=pending.metadatas[i:i + self._max_add_batch]
+                )
+            # Only record items once their chunks are safely in ChromaDB
+            with self._manifest:
+                self._manifest.executemany(
+                    "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, 0)",
+                    pending.manifest_rows
+                )
+                self._manifest.executemany(
+                    "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?)",
+                    pending.paper_rows
+                )
+            for key, *values in pending.paper_rows:
+                self._papers[key] = dict(zip(PAPER_FIELDS, values))
+        finally:
+            # Drop the batch even on failure so one bad add isn't retried on every flush
+            pending.clear()
+
+    def chunk_text_tokens(self, text: str, chunk_size: int = 256, overlap: int = 32) -> List[str]:
+        """Split text into overlapping chunks of exactly chunk_size model tokens (the last may be shorter)"""
+        if not text or len(text.strip()) == 0:
+            return []
+        if overlap >= chunk_size:
+            raise ValueError("overlap must be smaller than chunk_size")
+        
+        # Tokenize the whole document once and cut chunks along token offsets
+        offsets = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False
+        )['offset_mapping']
+        
+        chunks = []
+        step = chunk_size - overlap
+        for start in range(0, len(offsets), step):
+            window = offsets[start:start + chunk_size]
+            chunk = text[window[0][0]:window[-1][1]].strip()
+            if chunk:  # Only add non-empty chunks
+                chunks.append(chunk)
+            if start + chunk_size >= len(offsets):
+                break
+            
+        return chunks
+
+    def create_embeddings(self, chunk_size: int = 1000, overlap: int = 100, update_mode: str = "new_only", encode_batch_size: int = 64, add_batch_size: int = 5000, chunk_unit: str = "chars"):
         """
         Create embeddings for PDFs in the Zotero library and store in ChromaDB
         
         Args:
-            chunk_size: Size of text chunks
-            overlap: Overlap between chunks
-            batch_size: Number of chunks to process at once
+            chunk_size: Size of text chunks, in chunk_unit
+            overlap: Overlap between chunks, in chunk_unit
             update_mode: Either "new_only" to only add new papers or "update_all" to check for changes
+            encode_batch_size: Number of chunks the model encodes at once
+            add_batch_size: Number of chunks to accumulate across PDFs before adding them to ChromaDB
+                (capped at ChromaDB's maximum batch size)
+            chunk_unit: "chars" to chunk by characters or "tokens" to chunk by model tokens
         """
+        if chunk_unit not in ("chars", "tokens"):
+            raise ValueError(f"Unknown chunk_unit: {chunk_unit}. Use 'chars' or 'tokens'")
+        chunker = self.chunk_text_tokens if chunk_unit == "tokens" else self.chunk_text
+
         processed_pdfs = 0
         total_chunks = 0
         skipped_items = 0
+        unchanged_items = 0
+        
+        self.embedding_function.batch_size = encode_batch_size
+        add_batch_size = min(add_batch_size, self._max_add_batch)
+        pending = _PendingBatch()
+        
+        # Remember what storage looked like when this run started, for is_up_to_date
+        storage_snapshot = self._scan_storage()
+        # PDFs whose extraction or add failed, left out of the snapshot so the next run retries them
+        failed_paths = set()
         
         # Get existing Zotero keys from ChromaDB
-        existing_keys = set()
-        if self.collection.count() > 0:
-            existing_keys = {m['zotero_key'] for m in self.collection.get()['metadatas']}
+        existing_keys = self._collection_keys()
+        
+        # Make sure the manifest knows every embedded paper, even ones added before it existed
+        with self._manifest:
+            self._manifest.executemany(
+                "INSERT OR IGNORE INTO manifest (zotero_key) VALUES (?)",
+                ((key,) for key in existing_keys)
+            )
         
         # Get total number of items
         total_items = self.zot.count_items()
-        start = 0
         limit = 100  # Zotero's maximum items per request
         
         print(f"Found {total_items} total items in Zotero library")
         print(f"Found {len(existing_keys)} existing papers in ChromaDB")
         
-        with tqdm(total=total_items) as pbar:
-            while start < total_items:
-                items = self.zot.items(start=start, limit=limit)
-                
-                for item in items:
+        # Zotero API calls are blocking round-trips, so fetch pages and children concurrently
+        with ThreadPoolExecutor(max_workers=ZOTERO_WORKERS) as pool:
+            offsets = range(0, total_items, limit)
+            pages = list(tqdm(
+                pool.map(lambda start: self._zotero_call('items', start=start, limit=limit), offsets),
+                total=len(offsets),
+                desc="Fetching items"
+            ))
+            
+            # Skip attachments, and papers we already have if we're only adding new ones
+            to_process = [
+                item for page in pages for item in page
+                if item['data'].get('itemType') != 'attachment'
+                and not (update_mode == "new_only" and item['key'] in existing_keys)
+            ]
+            
+            pdf_paths = list(tqdm(
+                pool.map(self.find_pdf_path, to_process),
+                total=len(to_process),
+                desc="Locating PDFs"
+            ))
+        
+        # Skip papers whose Zotero version and PDF file are unchanged since they were embedded,
+        # or since they were found to have no text (such as scans without OCR)
+        manifest = {
+            row[0]: row[1:]
+            for row in self._manifest.execute(
+                "SELECT zotero_key, zot_version, pdf_path, pdf_mtime, sha1, empty FROM manifest"
+            )
+        }
+        jobs = []
+        for item, path in zip(to_process, pdf_paths):
+            if not path:
+                skipped_items += 1
+                continue
+            mtime = os.path.getmtime(path)
+            known = manifest.get(item['key'])
+            if (known and (item['key'] in existing_keys or known[4])
+                    and known[:3] == (item['version'], path, mtime)):
+                unchanged_items += 1
+                continue
+            jobs.append((item, path, mtime))
+        
+        # Extract PDF text in worker processes while the main process chunks and embeds. Only a couple
+        # of PDFs per worker are in flight, so extracted text can't pile up when embedding falls behind
+        workers = os.cpu_count() or 1
+        remaining = iter(jobs)
+        # Spawn rather than fork: forking a process that already runs torch threads can deadlock
+        extract_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=extract_context) as pool, tqdm(total=len(jobs), desc="Embedding PDFs") as pbar:
+            futures = {
+                pool.submit(extract_pdf, path): (item, path, mtime)
+                for item, path, mtime in itertools.islice(remaining, EXTRACT_IN_FLIGHT_PER_WORKER * workers)
+            }
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, path, mtime = futures.pop(future)
+                    # Top the queue back up before the slow embedding step, so workers stay busy
+                    for next_item, next_path, next_mtime in itertools.islice(remaining, 1):
+                        futures[pool.submit(extract_pdf, next_path)] = (next_item, next_path, next_mtime)
                     try:
-                        if item['data'].get('itemType') != 'attachment':
-                            zotero_key = item['key']
-                            
-                            # Skip if we already have this paper and we're only adding new ones
-                            if update_mode == "new_only" and zotero_key in existing_keys:
-                                pbar.update(1)
-                                continue
-                                
-                            # If updating all, remove existing embeddings for this paper
-                            if update_mode == "update_all" and zotero_key in existing_keys:
-                                self.collection.delete(
-                                    where={"zotero_key": zotero_key}
+                        text, sha1 = future.result()
+                        zotero_key = item['key']
+                        manifest_row = (zotero_key, item['version'], path, mtime, sha1)
+                        
+                        # A touched but byte-identical PDF only needs its manifest entry refreshed
+                        known = manifest.get(zotero_key)
+                        if (known and (zotero_key in existing_keys or known[4])
+                                and known[0] == item['version'] and known[3] == sha1):
+                            with self._manifest:
+                                self._manifest.execute(
+                                    "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)",
+                                    (*manifest_row, known[4])
                                 )
+                            unchanged_items += 1
+                            pbar.update(1)
+                            continue
+                        
+                        # If updating all, remove existing embeddings for this paper
+                        if update_mode == "update_all" and zotero_key in existing_keys:
+                            self.collection.delete(
+                                where={"zotero_key": zotero_key}
+                            )
+                        
+                        chunks = chunker(text, chunk_size, overlap) if text.strip() else []
+                        if chunks:
+                            total_chunks += len(chunks)
+                            processed_pdfs += 1
+                            metadata = self._item_metadata(item)
                             
-                            # Get PDF content
-                            text = self.get_pdf_content(item)
+                            # Queue chunks so embedding runs on large batches spanning several PDFs
+                            pending.extend(
+                                chunks,
+                                [str(uuid.uuid4()) for _ in chunks],
+                                [{
+                                    'zotero_key': zotero_key,
+                                    'chunk_index': idx,
+                                    'total_chunks': len(chunks)
+                                } for idx in range(len(chunks))]
+                            )
+                            pending.manifest_rows.append(manifest_row)
+                            pending.paper_rows.append((zotero_key, *(metadata[f] for f in PAPER_FIELDS)))
+                            if len(pending) >= add_batch_size:
+                                batch_paths = [row[2] for row in pending.manifest_rows]
+                                try:
+                                    self._flush(pending)
+                                except Exception:
+                                    failed_paths.update(batch_paths)  # Every PDF in the dropped batch
+                                    raise
+                        else:
+                            # Nothing to embed, but remember the PDF so unchanged runs don't extract it again
+                            skipped_items += 1
+                            with self._manifest:
+                                self._manifest.execute(
+                                    "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, 1)",
+                                    manifest_row
+                                )
                             
-                            if text and len(text.strip()) > 0:
-                                chunks = self.chunk_text(text, chunk_size, overlap)
-                                
-                                if chunks:
-                                    total_chunks += len(chunks)
-                                    processed_pdfs += 1
-                                    
-                                    # Convert authors to string format
-                                    authors = item['data'].get('creators', [])
-                                    author_strings = []
-                                    for author in authors:
-                                        if 'firstName' in author and 'lastName' in author:
-                                            author_strings.append(f"{author['firstName']} {author['lastName']}")
-                                        elif 'lastName' in author:
-                                            author_strings.append(author['lastName'])
-                                    
-                                    metadata = {
-                                        'title': item['data'].get('title', ''),
-                                        'authors': '; '.join(author_strings),
-                                        'year': item['data'].get('date', ''),
-                                        'doi': item['data'].get('DOI', ''),
-                                        'tags': ', '.join([tag.get('tag', '') for tag in item['data'].get('tags', [])]),
-                                        'zotero_key': zotero_key
-                                    }
-                                    
-                                    # Process chunks in batches
-                                    for i in range(0, len(chunks), batch_size):
-                                        batch_chunks = chunks[i:i + batch_size]
-                                        if batch_chunks:
-                                            batch_ids = [str(uuid.uuid4()) for _ in batch_chunks]
-                                            batch_metadatas = [{
-                                                **metadata,
-                                                'chunk_index': idx + i,
-                                                'total_chunks': len(chunks)
-                                            } for idx in range(len(batch_chunks))]
-                                            
-                                            self.collection.add(
-                                                documents=batch_chunks,
-                                                ids=batch_ids,
-                                                metadatas=batch_metadatas
-                                            )
-                                else:
-                                    skipped_items += 1
-                            else:
-                                skipped_items += 1
-                                
                     except Exception as e:
                         skipped_items += 1
+                        failed_paths.add(path)
                         print(f"\nError processing {item['data'].get('title', 'Unknown')}: {str(e)}")
                     
                     pbar.update(1)
-                
-                start += limit
+        
+        # Add whatever is left over
+        if pending:
+            self._flush(pending)
+        self.generation += 1
+        with self._manifest:
+            self._manifest.execute("DELETE FROM storage_snapshot")
+            self._manifest.executemany(
+                "INSERT INTO storage_snapshot VALUES (?, ?, ?)",
+                (
+                    (path, mtime, size) for path, (mtime, size) in storage_snapshot.items()
+                    if path not in failed_paths
+                )
+            )
+        with open(os.path.join(self.persist_directory, INGEST_MARKER), 'w'):
+            pass  # Truncating the marker bumps its mtime
         
         print("\nProcessing complete!")
         print(f"Successfully processed {processed_pdfs} PDFs")
         print(f"Created {total_chunks} new chunks")
         print(f"Skipped {skipped_items} items")
+        print(f"Left {unchanged_items} unchanged items as they were")
         
         return {
             'processed_pdfs': processed_pdfs,
             'total_chunks': total_chunks,
             'skipped_items': skipped_items,
+            'unchanged_items': unchanged_items,
             'avg_chunks_per_doc': total_chunks/processed_pdfs if processed_pdfs > 0 else 0
         }
 
-    def search(self, query: str, n_results: int = 5):
+    def search(self, query: str, n_results: int = 5, rerank: bool = False):
         """
         Search through embeddings using ChromaDB
         """
+        return self.search_batch([query], n_results, rerank)[0]
+
+    def search_batch(self, queries: List[str], n_results: int = 5, rerank: bool = False) -> List[List[Dict]]:
+        """
+        Search for several queries with one embedding call and one ChromaDB query
+        """
+        return self.search_embeddings(self.embedding_function.encode(queries), n_results, queries if rerank else None)
+
+    def rerank(self, query: str, results: List[Dict], n_results: int) -> List[Dict]:
+        """
+        Reorder search results by cross-encoder relevance to the query and keep the best n_results
+        """
+        if not results:
+            return results
+        scores = get_reranker(self.device).predict(
+            [(query, result['chunk']) for result in results],
+            show_progress_bar=False
+        )
+        order = np.argsort(-scores, kind='stable')[:n_results]
+        return [{**results[i], 'rerank_score': float(scores[i])} for i in order]
+
+    def search_embeddings(self, query_embeddings: np.ndarray, n_results: int = 5,
+                          rerank_queries: Optional[List[str]] = None) -> List[List[Dict]]:
+        """
+        Search with already-embedded queries, one result list per query. Given the query texts,
+        fetch extra candidates and keep the ones the cross-encoder ranks highest
+        """
         results = self.collection.query(
-            query_texts=[query],
-            n_results=n_results,
+            query_embeddings=query_embeddings,
+            n_results=n_results * RERANK_CANDIDATES if rerank_queries else n_results,
             include=['documents', 'metadatas', 'distances']
         )
+        # Chroma's l2 is squared distance, which for unit vectors is 2 - 2 * cosine
+        scale = 0.5 if self.space == "l2" else 1.0
         
-        formatted_results = []
-        for idx in range(len(results['documents'][0])):
-            formatted_results.append({
-                'chunk': results['documents'][0][idx],
-                'metadata': results['metadatas'][0][idx],
-                'distance': results['distances'][0][idx]
-            })
-            
-        return formatted_results
+        all_results = []
+        for documents, metadatas, distances in zip(results['documents'], results['metadatas'], results['distances']):
+            formatted_results = []
+            for idx in range(len(documents)):
+                formatted_results.append({
+                    'chunk': documents[idx],
+                    'metadata': self.paper_metadata(metadatas[idx]),
+                    'distance': distances[idx],
+                    'score': 1 - scale * distances[idx]
+                })
+            all_results.append(formatted_results)
+        
+        if rerank_queries:
+            return [self.rerank(query, candidates, n_results) for query, candidates in zip(rerank_queries, all_results)]
+        return all_results
+
 
+    def _collection_keys(self, page_size: int = 10000) -> set:
+        """Collect the distinct Zotero keys in the collection, one page of metadata at a time"""
+        keys = set()
+        offset = 0
+        while True:
+            page = self.collection.get(limit=page_size, offset=offset, include=["metadatas"])
+            keys.update(m['zotero_key'] for m in page['metadatas'])
+            if len(page['ids']) < page_size:
+                return keys
+            offset += page_size
 
     def get_collection_stats(self):
         """Get statistics about the embedded collection"""
+        total_documents = self._manifest.execute("SELECT COUNT(*) FROM manifest WHERE empty = 0").fetchone()[0]
+        if total_documents == 0:
+            # Manifest not populated yet, so count keys in the collection itself
+            total_documents = len(self._collection_keys())
         return {
             'total_chunks': self.collection.count(),
-            'total_documents': len(set(m['zotero_key'] for m in self.collection.get()['metadatas']))
+            'total_documents': total_documents
         }
     
     def test_pdf_access(self, limit: int = 5):
@@ -2,10 +2,22 @@ import os
 from pathlib import Path
 import toml
 import argparse
-from project import ZoteroEmbedder
-from sentence_transformers import SentenceTransformer
 from dataclasses import dataclass
-from typing import Tuple
+from typing import Tuple, TYPE_CHECKING
+from contextlib import contextmanager, nullcontext
+
+if TYPE_CHECKING:
+    # Only for annotations: spawned PDF extraction workers re-import this script as __main__,
+    # so its top level mustn't load torch and chromadb
+    from project import ZoteroEmbedder
+
+# Durability ChromaDB's SQLite gives up during --fast-ingest
+FAST_INGEST_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    'locking_mode': 'EXCLUSIVE',
+}
 
 @dataclass
 class ChunkingParams:
@@ -33,6 +45,31 @@ def calculate_chunk_size(
     
     return final_chunk_size, overlap
 
+def calculate_token_chunk_size(model_config: dict, params: ChunkingParams) -> Tuple[int, int]:
+    """Calculate chunk size and overlap in model tokens"""
+    chunk_size = int(model_config['max_tokens'] * params.max_token_utilization)
+    return chunk_size, int(chunk_size * params.overlap_ratio)
+
+@contextmanager
+def fast_ingest(embedder: "ZoteroEmbedder"):
+    """
+    Turn off journaling and fsync on ChromaDB's SQLite connection for a bulk rebuild.
+    A crash while this is active can corrupt the database, so it's only for one-shot rebuilds.
+    """
+    from chromadb.db.impl.sqlite import SqliteDB
+    
+    conn = embedder.chroma_client._system.instance(SqliteDB)._conn_pool.connect()
+    original = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in FAST_INGEST_PRAGMAS}
+    for name, value in FAST_INGEST_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    try:
+        yield
+    finally:
+        # Restore the safe settings and fold everything back into the main database file
+        for name, value in original.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
 def main():
     parser = argparse.ArgumentParser(description='Rebuild embeddings for Zotero papers')
     parser.add_argument('--mode', 
@@ -46,6 +83,17 @@ def main():
     parser.add_argument('--storage-path', 
                        default='~/Zotero/storage',
                        help='Path to Zotero storage')
+    parser.add_argument('--backend',
+                       choices=['torch', 'onnx'],
+                       default='torch',
+                       help='Embedding runtime: torch, or onnx for int8 ONNX Runtime on CPU')
+    parser.add_argument('--chunk-unit',
+                       choices=['chars', 'tokens'],
+                       default='chars',
+                       help='Measure chunk size and overlap in characters or in model tokens')
+    parser.add_argument('--fast-ingest',
+                       action='store_true',
+                       help='Disable SQLite journaling and fsync while ingesting (from_scratch only; a crash mid-rebuild loses the database)')
     parser.add_argument('--force-chunk-size', 
                        type=int,
                        help='Override automatic chunk size calculation')
@@ -66,6 +114,8 @@ def main():
                        help='Fraction of chunk size to use as overlap')
     
     args = parser.parse_args()
+    if args.fast_ingest and args.mode != 'from_scratch':
+        parser.error("--fast-ingest is only safe with --mode from_scratch")
     
     # Confirm destructive operations
     if args.mode in ['from_scratch', 'update_all']:
@@ -89,6 +139,8 @@ def main():
     if args.force_chunk_size:
         chunk_size = args.force_chunk_size
         overlap = args.force_overlap or chunking_config['default_overlap']
+    elif args.chunk_unit == 'tokens':
+        chunk_size, overlap = calculate_token_chunk_size(model_config, chunking_params)
     else:
         chunk_size, overlap = calculate_chunk_size(
             model_config, 
@@ -98,8 +150,8 @@ def main():
     
     print(f"\nConfiguration:")
     print(f"Model: {model_config['name']}")
-    print(f"Chunk size: {chunk_size} words")
-    print(f"Overlap: {overlap} words")
+    print(f"Chunk size: {chunk_size} {args.chunk_unit}")
+    print(f"Overlap: {overlap} {args.chunk_unit}")
     print(f"Words per token: {chunking_params.words_per_token}")
     print(f"Max token utilization: {chunking_params.max_token_utilization}")
     print(f"Overlap ratio: {chunking_params.overlap_ratio}")
@@ -112,24 +164,37 @@ def main():
             shutil.rmtree(storage_config['default_persist_directory'])
     
     # Initialize embedder after potential database clearing
+    from project import ZoteroEmbedder
     embedder = ZoteroEmbedder(
         storage_path=os.path.expanduser(args.storage_path),
-        persist_directory=storage_config['default_persist_directory']
+        persist_directory=storage_config['default_persist_directory'],
+        backend=args.backend
     )
     
+    # Token chunks longer than the model's window would be truncated when embedded
+    if args.chunk_unit == 'tokens':
+        max_chunk_tokens = embedder.model.max_seq_length - 2  # Room for [CLS] and [SEP]
+        if chunk_size > max_chunk_tokens:
+            print(f"Clamping chunk size to the model's {max_chunk_tokens}-token window")
+            chunk_size = max_chunk_tokens
+            overlap = min(overlap, chunk_size // 2)
+    
     print(f"\nCreating embeddings in {args.mode} mode...")
     
-    stats = embedder.create_embeddings(
-        chunk_size=chunk_size,
-        overlap=overlap,
-        update_mode=args.mode
-    )
+    with fast_ingest(embedder) if args.fast_ingest else nullcontext():
+        stats = embedder.create_embeddings(
+            chunk_size=chunk_size,
+            overlap=overlap,
+            update_mode=args.mode,
+            chunk_unit=args.chunk_unit
+        )
     
     print("\nEmbedding creation complete!")
     print(f"Processed PDFs: {stats['processed_pdfs']}")
     print(f"Total chunks created: {stats['total_chunks']}")
     print(f"Average chunks per document: {stats['avg_chunks_per_doc']:.2f}")
     print(f"Skipped items: {stats['skipped_items']}")
+    print(f"Unchanged items: {stats['unchanged_items']}")
     
     print("\nVerifying database contents...")
     verify_stats = embedder.get_collection_stats()
@@ -1,135 +1,404 @@
-from project import ZoteroEmbedder
-from llm_providers import MODEL_CONFIGS
-from typing import List, Dict
+from llm_providers import MODEL_CONFIGS, MODEL_NAMES
+from typing import Any, List, Dict, Optional, Tuple, Iterator, Union, TYPE_CHECKING
+from functools import lru_cache
+import asyncio
+import hashlib
+import json
+import uuid
 from dotenv import load_dotenv
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
+from response_cache import index_version
+
+if TYPE_CHECKING:
+    # Only for annotations, so importing the configs doesn't pull in torch and chromadb
+    from project import ZoteroEmbedder
 
 load_dotenv()
 
-@dataclass
+# Minimum cosine similarity between questions for the semantic cache to reuse an answer
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+@lru_cache(maxsize=None)
+def get_tokenizer(name: str):
+    """Load a Hugging Face tokenizer on first use"""
+    # Imported here so loading this module doesn't pull in transformers
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name, use_fast=True)
+
+def _check_token_budget(name: str, value: Optional[int]):
+    # A budget below one token would cut at offsets[-1] and keep nearly the whole text
+    if value is not None and value < 1:
+        raise ValueError(f"{name} must be at least 1, got {value}")
+
+@dataclass(frozen=True, slots=True)
 class QueryConfig:
     n_chunks: int = 5
-    max_chars_per_chunk: int = 8000
+    max_chars_per_chunk: Optional[int] = 8000
+    max_tokens_per_chunk: Optional[int] = None
+    rerank: bool = False
+    restate_question: bool = True
     system_prompt: str = "You are a superstar postdoctoral researcher with expertise in academic literature."
 
-@dataclass
+    def __post_init__(self):
+        _check_token_budget('max_tokens_per_chunk', self.max_tokens_per_chunk)
+
+@dataclass(frozen=True, slots=True)
 class AnalysisConfig:
-    max_chars: int = 8000
+    max_chars: Optional[int] = 8000
+    max_tokens: Optional[int] = None
     system_prompt: str = "You are a helpful research assistant with expertise in analyzing academic papers."
 
-@dataclass
+    def __post_init__(self):
+        _check_token_budget('max_tokens', self.max_tokens)
+
+@dataclass(frozen=True, slots=True)
 class ComparisonConfig:
-    max_chars_per_paper: int = 4000
+    max_chars_per_paper: Optional[int] = 4000
+    max_tokens_per_paper: Optional[int] = None
     system_prompt: str = "You are a helpful research assistant with expertise in analyzing and comparing academic papers."
 
+    def __post_init__(self):
+        _check_token_budget('max_tokens_per_paper', self.max_tokens_per_paper)
+
+# Prompt templates are built once; only the per-request slots are filled in with format_map
+_SEP = '-' * 80
+
+_CONTEXT_TEMPLATE = "From '{title}' by {authors} ({year}):\n{chunk}\n"
+
+# The question goes last, right before the model answers, so it isn't lost behind the excerpts;
+# a copy up front (dropped by QueryConfig.restate_question=False) helps it read them with the question in mind.
+# Only used without prompt caching, where nothing ahead of the excerpts may depend on the question
+_QUERY_PREVIEW_TEMPLATE = """Question: {question}
+
+"""
+
+_QUERY_CONTEXT_TEMPLATE = f"""Use relevant content from the following excerpts from academic papers to answer the question that follows them.
+If you're not sure about something, say so, and specifically say what you would like more information about, citing particular references or sources you would like to see more from. Include citations in your response.
+
+Relevant excerpts:
+{_SEP}
+{{context}}
+{_SEP}
+
+"""
+
+_QUERY_QUESTION_TEMPLATE = """Question: {question}
+
+Answer using only the excerpts above. Please provide a detailed answer, including specific citations where appropriate."""
+
+_ANALYSIS_PAPER_TEMPLATE = """Analyze the following academic paper and provide a comprehensive summary:
+
+Title: {title}
+Authors: {authors}
+Year: {year}
+
+Content:
+{text}
+
+"""
+
+_ANALYSIS_INSTRUCTIONS = """Please provide:
+1. Main research questions/objectives
+2. Key methodology
+3. Main findings
+4. Significant conclusions
+5. Potential implications for the field"""
+
+_COMPARISON_HEADER = "Compare and contrast the following papers:\n\n"
+
+_COMPARISON_PAPER_TEMPLATE = """
+Title: {title}
+Authors: {authors}
+Year: {year}
+
+Content:
+{text}
+
+---
+"""
+
+_COMPARISON_INSTRUCTIONS = """
+Please provide:
+1. Key similarities in methodology and findings
+2. Major differences in approach or conclusions
+3. How these papers complement or contradict each other
+4. Evolution of ideas if papers are from different time periods
+5. Synthesis of the combined insights from these papers"""
+
+DEFAULT_QUERY_CONFIG = QueryConfig()
+DEFAULT_ANALYSIS_CONFIG = AnalysisConfig()
+DEFAULT_COMPARISON_CONFIG = ComparisonConfig()
+
 class ResearchAssistant:
-    def __init__(self, embedder: ZoteroEmbedder, model_name: str = "gpt-4"):
+    def __init__(self, embedder: "ZoteroEmbedder", model_name: str = "gpt-4", enable_prompt_cache: bool = False,
+                 semantic_cache_threshold: Optional[float] = None):
         self.embedder = embedder
+        self.model_name = model_name
+        self.enable_prompt_cache = enable_prompt_cache
+        
+        # Answers to earlier questions, searchable by question embedding
+        self.semantic_cache_threshold = semantic_cache_threshold
+        if semantic_cache_threshold is not None:
+            self._response_cache = embedder.chroma_client.get_or_create_collection(
+                name="response_cache",
+                embedding_function=None,
+                metadata={"hnsw:space": "ip"}
+            )
         
         if model_name not in MODEL_CONFIGS:
-            raise ValueError(f"Unknown model: {model_name}. Available models: {list(MODEL_CONFIGS.keys())}")
+            raise ValueError(f"Unknown model: {model_name}. Available models: {list(MODEL_NAMES)}")
         
         config = MODEL_CONFIGS[model_name]
         self.llm = config["provider"](**config["args"])
+        self.tokenizer_name = config["tokenizer"]
         print(f"Using model: {config['description']}")
+        
+        # Per-instance cache of paper lookups, keyed on the embedder's generation so re-ingesting invalidates it
+        self._load_papers = lru_cache(maxsize=256)(self._load_papers_uncached)
+
+    def _load_papers_uncached(self, titles: Tuple[str, ...], generation: int) -> Dict[str, Tuple[str, Dict]]:
+        return {
+            title: ("\n".join(documents), metadata)
+            for title, (documents, metadata) in self.embedder.get_papers(list(titles)).items()
+        }
+
+    def get_papers(self, titles: List[str]) -> Dict[str, Tuple[str, Dict]]:
+        """Get the full text and metadata of the papers found among titles, in the given order"""
+        return self._load_papers(tuple(titles), self.embedder.generation)
+
+    def get_paper(self, title: str) -> Optional[Tuple[str, Dict]]:
+        """Get a paper's full text and metadata by title"""
+        return self.get_papers([title]).get(title)
+
+    def _truncate(self, text: str, max_chars: Optional[int], max_tokens: Optional[int]) -> str:
+        """Cut text to at most max_chars characters and max_tokens tokens of the model's tokenizer"""
+        return self._truncate_many([text], max_chars, max_tokens)[0]
+
+    def _truncate_many(self, texts: List[str], max_chars: Optional[int], max_tokens: Optional[int]) -> List[str]:
+        """Truncate several texts, tokenizing them in one batch the tokenizer spreads across its threads"""
+        texts = [text[:max_chars] for text in texts]
+        if max_tokens is None:
+            return texts
+        encodings = get_tokenizer(self.tokenizer_name)(
+            texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False
+        )
+        # Cut the original strings at a token boundary rather than decoding tokens back
+        return [
+            text if len(offsets) <= max_tokens else text[:offsets[max_tokens - 1][1]]
+            for text, offsets in zip(texts, encodings['offset_mapping'])
+        ]
+
+    def _user_message(self, prefix: str, suffix: str) -> Dict:
+        """Build the user message, marking the stable prefix cacheable when prompt caching is on"""
+        if not self.enable_prompt_cache:
+            return {"role": "user", "content": prefix + suffix}
+        # Anthropic caches up to the marked block; other providers get the blocks joined back into
+        # one string and cache the shared prefix automatically
+        return {"role": "user", "content": [
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": suffix}
+        ]}
+
+    def _respond(self, messages: List[Dict[str, str]], stream: bool) -> Union[str, Iterator[str]]:
+        """Generate the answer, either all at once or as a stream of text pieces"""
+        return self.llm.generate_stream(messages) if stream else self.llm.generate(messages)
+
+    def _semantic_cache_settings(self, config: QueryConfig) -> str:
+        """Hash of everything besides the question that shapes an answer"""
+        return hashlib.sha256(json.dumps({
+            'config': asdict(config),
+            'prompt_cache': self.enable_prompt_cache,
+            'index_version': index_version(self.embedder.persist_directory)
+        }, sort_keys=True).encode()).hexdigest()
+
+    def _lookup_answer(self, question_embedding, settings: str) -> Optional[str]:
+        """Return a cached answer to a near-identical question asked with the same model and settings"""
+        if self._response_cache.count() == 0:
+            return None
+        hit = self._response_cache.query(
+            query_embeddings=question_embedding,
+            n_results=1,
+            where={"$and": [{"model": self.model_name}, {"settings": settings}]},
+            include=['documents', 'distances']
+        )
+        # Unit-length vectors in inner-product space, so similarity is 1 - distance
+        if hit['documents'][0] and 1 - hit['distances'][0][0] >= self.semantic_cache_threshold:
+            return hit['documents'][0][0]
+        return None
 
-    def query(self, question: str, config: QueryConfig = QueryConfig()) -> str:
-        results = self.embedder.search(question, n_results=config.n_chunks)
+    def _remember_answer(self, question_embedding, settings: str, answer: str):
+        self._response_cache.add(
+            ids=[str(uuid.uuid4())],
+            embeddings=question_embedding,
+            documents=[answer],
+            metadatas=[{"model": self.model_name, "settings": settings}]
+        )
+
+    def _stream_and_remember(self, deltas: Iterator[str], question_embedding, settings: str) -> Iterator[str]:
+        parts = []
+        for delta in deltas:
+            parts.append(delta)
+            yield delta
+        self._remember_answer(question_embedding, settings, "".join(parts))
+
+    def _retrieve(self, questions: List[str], question_embeddings, config: QueryConfig) -> List[List[Dict]]:
+        """Find the chunks nearest each embedded question, with one ChromaDB query for them all"""
+        return self.embedder.search_embeddings(
+            question_embeddings,
+            n_results=config.n_chunks,
+            rerank_queries=questions if config.rerank else None
+        )
+
+    def _query_messages(self, question: str, results: List[Dict], config: QueryConfig) -> List[Dict]:
+        """Build the prompt around the chunks retrieved for the question"""
+        chunks = self._truncate_many(
+            [result['chunk'] for result in results], config.max_chars_per_chunk, config.max_tokens_per_chunk
+        )
+        context = [
+            _CONTEXT_TEMPLATE.format_map({
+                'title': result['metadata']['title'],
+                'authors': result['metadata']['authors'],
+                'year': result['metadata']['year'],
+                'chunk': chunk
+            })
+            for result, chunk in zip(results, chunks)
+        ]
         
-        context = []
-        for result in results:
-            context.append(
-                f"From '{result['metadata']['title']}' by {result['metadata']['authors']} ({result['metadata']['year']}):\n"
-                f"{result['chunk'][:config.max_chars_per_chunk]}\n"
-            )
+        prefix = _QUERY_CONTEXT_TEMPLATE.format_map({'context': '\n'.join(context)})
+        # A cacheable prefix can't mention the question, so prompt caching skips the preview
+        if config.restate_question and not self.enable_prompt_cache:
+            prefix = _QUERY_PREVIEW_TEMPLATE.format_map({'question': question}) + prefix
         
-        messages = [
+        return [
             {"role": "system", "content": config.system_prompt},
-            {"role": "user", "content": f"""Use relevant content from the following excerpts from academic papers to answer the question below.
-If you're not sure about something, say so, and specifically say what you would like more information about, citing particular references or sources you would like to see more from. Include citations in your response.
-
-Question: {question}
+            self._user_message(prefix, _QUERY_QUESTION_TEMPLATE.format_map({'question': question}))
+        ]
 
-Relevant excerpts:
-{'-' * 80}
-{'\n'.join(context)}
-{'-' * 80}
+    def query(self, question: str, config: Optional[QueryConfig] = None, stream: bool = False) -> Union[str, Iterator[str]]:
+        config = config or DEFAULT_QUERY_CONFIG
+        
+        # Embed the question once for both the semantic cache and the search
+        question_embedding = self.embedder.embedding_function.encode([question])
+        if self.semantic_cache_threshold is not None:
+            settings = self._semantic_cache_settings(config)
+            cached = self._lookup_answer(question_embedding, settings)
+            if cached is not None:
+                return cached
+        
+        results = self._retrieve([question], question_embedding, config)[0]
+        messages = self._query_messages(question, results, config)
+        response = self._respond(messages, stream)
+        if self.semantic_cache_threshold is None:
+            return response
+        if stream:
+            return self._stream_and_remember(response, question_embedding, settings)
+        self._remember_answer(question_embedding, settings, response)
+        return response
 
-Please provide a detailed answer based on these sources, including specific citations where appropriate."""}
+    def _prepare_queries(self, questions: List[str], config: QueryConfig,
+                         settings: Optional[str]) -> Tuple[Any, List[Optional[str]], Dict[int, List[Dict]]]:
+        """Embed and retrieve for all questions as one batch: their embeddings, any cached answers, and prompts for the rest"""
+        question_embeddings = self.embedder.embedding_function.encode(questions)
+        answers = [
+            self._lookup_answer(question_embeddings[i:i + 1], settings) if settings is not None else None
+            for i in range(len(questions))
         ]
+        
+        missing = [i for i, cached in enumerate(answers) if cached is None]
+        prompts = {}
+        if missing:
+            results = self._retrieve([questions[i] for i in missing], question_embeddings[missing], config)
+            prompts = {i: self._query_messages(questions[i], chunks, config) for i, chunks in zip(missing, results)}
+        return question_embeddings, answers, prompts
 
-        return self.llm.generate(messages)
-
-    def analyze_paper(self, title: str, config: AnalysisConfig = AnalysisConfig()) -> str:
-        results = self.embedder.collection.get(
-            where={"title": title}
+    async def aquery_many(self, questions: List[str], config: Optional[QueryConfig] = None,
+                          max_concurrency: int = 4) -> List[str]:
+        """
+        Answer several questions, with at most max_concurrency LLM calls in flight. Embedding and retrieval
+        run once for the whole batch in a worker thread, since the embedding model can't be shared between
+        threads; only the LLM calls overlap
+        """
+        config = config or DEFAULT_QUERY_CONFIG
+        settings = self._semantic_cache_settings(config) if self.semantic_cache_threshold is not None else None
+        question_embeddings, answers, prompts = await asyncio.to_thread(
+            self._prepare_queries, questions, config, settings
         )
         
-        if not results['documents']:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def ask(i: int, messages: List[Dict]):
+            async with semaphore:
+                answers[i] = await self.llm.agenerate(messages)
+        
+        await asyncio.gather(*(ask(i, messages) for i, messages in prompts.items()))
+        
+        if settings is not None:
+            def remember():
+                for i in prompts:
+                    self._remember_answer(question_embeddings[i:i + 1], settings, answers[i])
+            await asyncio.to_thread(remember)
+        return answers
+
+    async def aquery(self, question: str, config: Optional[QueryConfig] = None) -> str:
+        """Answer a question without blocking the event loop"""
+        return (await self.aquery_many([question], config))[0]
+
+    def analyze_paper(self, title: str, config: Optional[AnalysisConfig] = None, stream: bool = False) -> Union[str, Iterator[str]]:
+        config = config or DEFAULT_ANALYSIS_CONFIG
+        paper = self.get_paper(title)
+        
+        if paper is None:
             return f"Paper '{title}' not found in the database."
         
-        text = "\n".join(results['documents'])
-        metadata = results['metadatas'][0]
+        text, metadata = paper
 
         messages = [
             {"role": "system", "content": config.system_prompt},
-            {"role": "user", "content": f"""Analyze the following academic paper and provide a comprehensive summary:
-
-Title: {metadata['title']}
-Authors: {metadata['authors']}
-Year: {metadata['year']}
-
-Content:
-{text[:config.max_chars]}
-
-Please provide:
-1. Main research questions/objectives
-2. Key methodology
-3. Main findings
-4. Significant conclusions
-5. Potential implications for the field"""}
+            self._user_message(
+                _ANALYSIS_PAPER_TEMPLATE.format_map({
+                    'title': metadata['title'],
+                    'authors': metadata['authors'],
+                    'year': metadata['year'],
+                    'text': self._truncate(text, config.max_chars, config.max_tokens)
+                }),
+                _ANALYSIS_INSTRUCTIONS
+            )
         ]
 
-        return self.llm.generate(messages)
+        return self._respond(messages, stream)
 
-    def compare_papers(self, titles: List[str], config: ComparisonConfig = ComparisonConfig()) -> str:
-        papers_data = []
-        for title in titles:
-            results = self.embedder.collection.get(
-                where={"title": title}
-            )
-            if results['documents']:
-                papers_data.append({
-                    'title': title,
-                    'text': "\n".join(results['documents']),
-                    'metadata': results['metadatas'][0]
-                })
+    def compare_papers(self, titles: List[str], config: Optional[ComparisonConfig] = None, stream: bool = False) -> Union[str, Iterator[str]]:
+        config = config or DEFAULT_COMPARISON_CONFIG
+        papers_data = [
+            {
+                'title': title,
+                'text': text,
+                'metadata': metadata
+            }
+            for title, (text, metadata) in self.get_papers(titles).items()
+        ]
         
         if not papers_data:
             return "None of the specified papers were found in the database."
 
-        prompt = "Compare and contrast the following papers:\n\n"
-        for paper in papers_data:
-            prompt += f"""
-Title: {paper['metadata']['title']}
-Authors: {paper['metadata']['authors']}
-Year: {paper['metadata']['year']}
-
-Content:
-{paper['text'][:config.max_chars_per_paper]}
-
----
-"""
+        texts = self._truncate_many(
+            [paper['text'] for paper in papers_data], config.max_chars_per_paper, config.max_tokens_per_paper
+        )
+        parts = [_COMPARISON_HEADER]
+        for paper, text in zip(papers_data, texts):
+            parts.append(_COMPARISON_PAPER_TEMPLATE.format_map({
+                'title': paper['metadata']['title'],
+                'authors': paper['metadata']['authors'],
+                'year': paper['metadata']['year'],
+                'text': text
+            }))
 
         messages = [
             {"role": "system", "content": config.system_prompt},
-            {"role": "user", "content": prompt + """
-Please provide:
-1. Key similarities in methodology and findings
-2. Major differences in approach or conclusions
-3. How these papers complement or contradict each other
-4. Evolution of ideas if papers are from different time periods
-5. Synthesis of the combined insights from these papers"""}
+            self._user_message("".join(parts), _COMPARISON_INSTRUCTIONS)
         ]
 
-        return self.llm.generate(messages)
\ No newline at end of file
+        return self._respond(messages, stream)
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import time
+import json
+import hashlib
+import sqlite3
+from typing import Optional
+
+RESPONSE_CACHE_PATH = os.path.expanduser('~/.cache/tryllm/responses.sqlite')
+RESPONSE_TTL = 7 * 86400  # Seconds a cached answer stays valid
+
+# Touched in the embedding database after every ingest, so cached answers can tell the index changed
+INGEST_MARKER = ".last_ingest"
+
+def index_version(persist_directory: str) -> int:
+    """When the embedding database was last ingested into, so re-ingesting invalidates cached answers"""
+    try:
+        return os.stat(os.path.join(persist_directory, INGEST_MARKER)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+class ResponseCache:
+    """On-disk cache of LLM answers keyed by a hash of everything that determines them"""
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl: float = RESPONSE_TTL):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def make_key(**fields) -> str:
+        """Hash the request fields into a stable cache key"""
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT response FROM responses WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, response: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, time.time() + self.ttl)
+            )
+
+    def close(self):
+        self.conn.close()
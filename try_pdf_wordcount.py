@@ -1,18 +1,32 @@
 import fitz  # PyMuPDF
 from collections import Counter
 import re
+import string
+from pdf_text import PDF_TEXT_FLAGS
+
+# Same words as r'\b\w+\b', without the boundary checks
+_WORD_RE = re.compile(r'\w+')
+
+# For ASCII text, every non-word character becomes a space so str.split finds the words
+_ASCII_WORD_CHARS = set(string.ascii_letters + string.digits + '_')
+_NON_WORD_TO_SPACE = str.maketrans({chr(c): ' ' for c in range(128) if chr(c) not in _ASCII_WORD_CHARS})
+
+def split_words(text):
+    """Lowercase text and split it into words, using a single translate+split pass for ASCII text"""
+    text = text.lower()
+    if text.isascii():
+        return text.translate(_NON_WORD_TO_SPACE).split()
+    return _WORD_RE.findall(text)
 
 def count_words_in_pdf(pdf_path):
     # Open the PDF
     doc = fitz.open(pdf_path)
     
     # Extract text from all pages
-    text = ""
-    for page in doc:
-        text += page.get_text()
+    text = "".join(page.get_text("text", flags=PDF_TEXT_FLAGS, sort=False) for page in doc)
     
     # Clean and split the text into words
-    words = re.findall(r'\b\w+\b', text.lower())
+    words = split_words(text)
     
     # Count words
     word_counts = Counter(words)
@@ -33,9 +47,7 @@ def extract_text_to_file(pdf_path, output_path):
     doc = fitz.open(pdf_path)
     
     # Extract text from all pages
-    text = ""
-    for page in doc:
-        text += page.get_text()
+    text = "".join(page.get_text("text", flags=PDF_TEXT_FLAGS, sort=False) for page in doc)
     
     # Write to file
     with open(output_path, 'w', encoding='utf-8') as f:
@@ -1,32 +1,242 @@
-from project import ZoteroEmbedder
-from research_assistant import ResearchAssistant, QueryConfig, AnalysisConfig, ComparisonConfig
+from research_assistant import (
+    ResearchAssistant, QueryConfig, AnalysisConfig, ComparisonConfig,
+    DEFAULT_QUERY_CONFIG, DEFAULT_ANALYSIS_CONFIG, DEFAULT_COMPARISON_CONFIG,
+    SEMANTIC_CACHE_THRESHOLD
+)
 import os
+import sys
+import json
+import asyncio
+import contextlib
+import threading
+import socket
+import socketserver
 from dotenv import load_dotenv
-from llm_providers import MODEL_CONFIGS
+from llm_providers import MODEL_CONFIGS, MODEL_NAMES
 import argparse
-from typing import List
+from typing import List, Dict, Iterator, Optional
+from dataclasses import asdict
+from response_cache import ResponseCache, index_version
+
+# Absolute, so a server started from another directory uses the same database as the CLI
+PERSIST_DIRECTORY = os.path.abspath('chroma_db')
+MAX_CONCURRENCY = 4  # Questions in flight at once with --questions
+SOCKET_PATH = os.path.expanduser('~/.tryllm/sock')
+
+# Assistant method and config type for each mode
+MODES = {
+    'query': ('query', QueryConfig),
+    'analyze': ('analyze_paper', AnalysisConfig),
+    'compare': ('compare_papers', ComparisonConfig)
+}
 
 def list_available_models() -> List[str]:
     print("\nAvailable models:")
     for name, config in MODEL_CONFIGS.items():
         print(f"- {name}: {config['description']}")
-    return list(MODEL_CONFIGS.keys())
+    return list(MODEL_NAMES)
+
+class ListModelsAction(argparse.Action):
+    """Print the model catalog and exit, like --help, without requiring the other arguments"""
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, default=argparse.SUPPRESS, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        list_available_models()
+        parser.exit()
+
+def make_assistant(embedder, model: str, prompt_cache: bool, semantic_cache: bool) -> ResearchAssistant:
+    return ResearchAssistant(
+        embedder,
+        model_name=model,
+        enable_prompt_cache=prompt_cache,
+        semantic_cache_threshold=SEMANTIC_CACHE_THRESHOLD if semantic_cache else None
+    )
+
+def answer(assistant: ResearchAssistant, request: Dict) -> Iterator[Dict]:
+    """Run a request, yielding {"delta": text} pieces then {"done": True, "cached_tokens": n}"""
+    method_name, config_type = MODES[request['mode']]
+    result = getattr(assistant, method_name)(
+        request['target'],
+        config_type(**request['config']),
+        stream=request['stream']
+    )
+    # Not-found messages come back as plain strings even when streaming
+    for delta in ([result] if isinstance(result, str) else result):
+        yield {"delta": delta}
+    yield {"done": True, "cached_tokens": assistant.llm.cached_prompt_tokens()}
+
+class AssistantServer(socketserver.UnixStreamServer):
+    """Keeps the embedder, and an assistant per model, loaded between CLI calls"""
+    def __init__(self, path: str):
+        self.embedder = None
+        self.source = None  # (persist directory, storage path) the embedder was loaded from
+        self.index_version = None
+        self.assistants = {}
+        super().__init__(path, AssistantRequestHandler)
+
+    def load(self, persist_directory: str, storage_path: str):
+        """(Re)load the embedder, dropping assistants built on the previous one"""
+        # Read before loading, so an ingest that lands mid-load shows up as a newer version next time
+        self.index_version = index_version(persist_directory)
+        self.embedder = load_embedder(storage_path, persist_directory)
+        self.source = (persist_directory, storage_path)
+        self.assistants = {}
+
+    def get_assistant(self, request: Dict) -> ResearchAssistant:
+        # Reload after a re-ingest, or when asked about a different database or library
+        source = (request['persist_directory'], request['storage_path'])
+        if source != self.source or request['index_version'] != self.index_version:
+            print(f"Loading the embedder from {source[0]} (index version {request['index_version']})")
+            self.load(*source)
+        
+        key = (request['model'], request['prompt_cache'], request['semantic_cache'])
+        if key not in self.assistants:
+            self.assistants[key] = make_assistant(self.embedder, *key)
+        return self.assistants[key]
+
+class AssistantRequestHandler(socketserver.StreamRequestHandler):
+    """Answers one JSON request per connection with JSON lines"""
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            assistant = self.server.get_assistant(request)
+            for reply in answer(assistant, request):
+                if 'done' in reply:
+                    # Lets the client tell whether the answer came from the index version it expected
+                    reply['index_version'] = self.server.index_version
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+        except Exception as e:
+            self.wfile.write((json.dumps({"error": str(e)}) + "\n").encode())
+
+def serve(storage_path: str):
+    """Load the embedder once and answer requests forwarded by other CLI invocations"""
+    running = _connect()
+    if running is not None:
+        running.close()
+        print(f"A server is already listening on {SOCKET_PATH}")
+        return
+    
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)  # Left behind by a server that didn't shut down cleanly
+    with AssistantServer(SOCKET_PATH) as server:
+        # Load up front for the default database, so the first request doesn't wait for it
+        server.load(PERSIST_DIRECTORY, resolve_storage_path(storage_path))
+        print(f"Serving on {SOCKET_PATH}, Ctrl-C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(SOCKET_PATH)
+
+def _connect() -> Optional[socket.socket]:
+    """Connect to a running server, or return None if there isn't one"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+def forward_replies(request: Dict) -> Optional[Iterator[Dict]]:
+    """Send a request to a running server and return its replies, or None if no server is running"""
+    sock = _connect()
+    if sock is None:
+        return None
+    return _read_replies(sock, request)
+
+def _read_replies(sock: socket.socket, request: Dict) -> Iterator[Dict]:
+    with sock:
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile('rb') as replies:
+            for line in replies:
+                yield json.loads(line)
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def _write_all(text: str):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def resolve_storage_path(storage_path: str) -> str:
+    return os.path.abspath(os.path.expanduser(storage_path))
+
+def load_embedder(storage_path: str, persist_directory: str):
+    # Imported here so --help, bad arguments and cache hits don't pay for torch and chromadb
+    from project import ZoteroEmbedder
+    
+    # Load environment variables
+    load_dotenv()
+    
+    return ZoteroEmbedder(storage_path=storage_path, persist_directory=persist_directory)
+
+def load_assistant(args) -> ResearchAssistant:
+    """Load the embedder and build an assistant in this process"""
+    embedder = load_embedder(resolve_storage_path(args.storage_path), PERSIST_DIRECTORY)
+    return make_assistant(embedder, args.model, args.prompt_cache, args.semantic_cache)
+
+def response_cache_key(args, target, config, version: int) -> str:
+    return ResponseCache.make_key(
+        mode=args.mode,
+        model=args.model,
+        target=target,
+        config=asdict(config),
+        prompt_cache=args.prompt_cache,
+        index_version=version
+    )
+
+def ask_questions(args, config: QueryConfig):
+    """Answer --questions concurrently, asking the LLM only those without a cached answer"""
+    cache = None if args.no_cache else ResponseCache()
+    version = index_version(PERSIST_DIRECTORY)
+    keys = [response_cache_key(args, question, config, version) for question in args.questions]
+    answers = [cache.get(key) if cache else None for key in keys]
+    
+    missing = [i for i, result in enumerate(answers) if result is None]
+    if missing:
+        assistant = load_assistant(args)
+        fresh = asyncio.run(assistant.aquery_many(
+            [args.questions[i] for i in missing], config, args.max_concurrency
+        ))
+        for i, result in zip(missing, fresh):
+            answers[i] = result
+            if cache:
+                cache.set(keys[i], result)
+    
+    for question, result in zip(args.questions, answers):
+        print(f"\nQ: {question}\n{result}")
 
 def main():
     parser = argparse.ArgumentParser(description='Research Assistant CLI')
     parser.add_argument('--mode',
-                       choices=['query', 'analyze', 'compare'],
-                       required=True,
+                       choices=list(MODES),
                        help='Operation mode')
     parser.add_argument('--model',
                        default='claude-sonnet',
-                       choices=list(MODEL_CONFIGS.keys()),
+                       choices=MODEL_NAMES,
                        help='LLM model to use')
+    parser.add_argument('--list-models',
+                       action=ListModelsAction,
+                       help='List the available models and exit')
     parser.add_argument('--storage-path',
                        default='~/Zotero/storage',
                        help='Path to Zotero storage')
     parser.add_argument('--question',
                        help='Research question to ask (for query mode)')
+    parser.add_argument('--questions',
+                       nargs='+',
+                       help='Several research questions to answer concurrently (for query mode)')
+    parser.add_argument('--max-concurrency',
+                       type=positive_int,
+                       default=MAX_CONCURRENCY,
+                       help='Most questions sent to the LLM at once with --questions')
     parser.add_argument('--title',
                        help='Paper title to analyze (for analyze mode)')
     parser.add_argument('--titles',
@@ -36,57 +246,147 @@ def main():
                        type=int,
                        default=5,
                        help='Number of relevant chunks to include')
+    parser.add_argument('--rerank',
+                       action='store_true',
+                       help='Rerank extra candidate chunks with a cross-encoder before keeping --n-chunks (query mode)')
+    parser.add_argument('--minimal-prompt',
+                       action='store_true',
+                       help='Ask the question only after the excerpts, without the copy before them (query mode). '
+                            'The copy is only added with --no-prompt-cache, since the cached excerpts must come first, '
+                            'so this has no effect with prompt caching on')
     parser.add_argument('--max-chars',
                        type=int,
-                       default=8000,
-                       help='Maximum characters per chunk/paper')
+                       help='Maximum characters per chunk/paper (default 8000, or no limit with --max-tokens)')
+    parser.add_argument('--max-tokens',
+                       type=positive_int,
+                       help="Maximum tokens per chunk/paper, counted with the model's tokenizer")
     parser.add_argument('--system-prompt',
                        help='Override default system prompt')
+    parser.add_argument('--prompt-cache',
+                       action=argparse.BooleanOptionalAction,
+                       default=True,
+                       help='Ask the provider to cache the retrieved excerpts/paper text between calls')
+    parser.add_argument('--stream',
+                       action=argparse.BooleanOptionalAction,
+                       default=True,
+                       help='Print the answer as it is generated')
+    parser.add_argument('--no-cache',
+                       action='store_true',
+                       help='Always call the LLM instead of reusing a cached answer')
+    parser.add_argument('--semantic-cache',
+                       action='store_true',
+                       help=f'Reuse the answer to a previous question with cosine similarity >= {SEMANTIC_CACHE_THRESHOLD} (query mode)')
+    parser.add_argument('--serve',
+                       action='store_true',
+                       help=f'Keep the embedder loaded and answer other invocations over {SOCKET_PATH}')
     
     args = parser.parse_args()
     
-    # Load environment variables
-    load_dotenv()
-    
-    # Initialize embedder
-    embedder = ZoteroEmbedder(
-        storage_path=os.path.expanduser(args.storage_path),
-        persist_directory='chroma_db'
-    )
+    if args.serve:
+        serve(args.storage_path)
+        return
+    if not args.mode:
+        parser.error("--mode is required")
     
-    # Initialize assistant
-    assistant = ResearchAssistant(embedder, model_name=args.model)
+    # Token budgets are the better measure, so they replace the default character cap
+    max_chars = args.max_chars
+    if max_chars is None and args.max_tokens is None:
+        max_chars = 8000
     
     # Create appropriate config based on mode
     if args.mode == 'query':
-        if not args.question:
-            parser.error("--question is required for query mode")
+        if not args.question and not args.questions:
+            parser.error("--question or --questions is required for query mode")
         config = QueryConfig(
             n_chunks=args.n_chunks,
-            max_chars_per_chunk=args.max_chars,
-            system_prompt=args.system_prompt or QueryConfig().system_prompt
+            rerank=args.rerank,
+            restate_question=not args.minimal_prompt,
+            max_chars_per_chunk=max_chars,
+            max_tokens_per_chunk=args.max_tokens,
+            system_prompt=args.system_prompt or DEFAULT_QUERY_CONFIG.system_prompt
         )
-        result = assistant.query(args.question, config)
+        if args.questions:
+            ask_questions(args, config)
+            return
+        target = args.question
         
     elif args.mode == 'analyze':
         if not args.title:
             parser.error("--title is required for analyze mode")
         config = AnalysisConfig(
-            max_chars=args.max_chars,
-            system_prompt=args.system_prompt or AnalysisConfig().system_prompt
+            max_chars=max_chars,
+            max_tokens=args.max_tokens,
+            system_prompt=args.system_prompt or DEFAULT_ANALYSIS_CONFIG.system_prompt
         )
-        result = assistant.analyze_paper(args.title, config)
+        target = args.title
         
     elif args.mode == 'compare':
         if not args.titles or len(args.titles) < 2:
             parser.error("--titles with at least 2 papers is required for compare mode")
         config = ComparisonConfig(
-            max_chars_per_paper=args.max_chars,
-            system_prompt=args.system_prompt or ComparisonConfig().system_prompt
+            max_chars_per_paper=max_chars,
+            max_tokens_per_paper=args.max_tokens,
+            system_prompt=args.system_prompt or DEFAULT_COMPARISON_CONFIG.system_prompt
         )
-        result = assistant.compare_papers(args.titles, config)
+        target = args.titles
+    
+    # Identical requests against an unchanged index get the same answer, so check the cache
+    # before paying for the embedder and the LLM
+    cache = None if args.no_cache else ResponseCache()
+    version = index_version(PERSIST_DIRECTORY)
+    cache_key = response_cache_key(args, target, config, version)
+    result = cache.get(cache_key) if cache else None
+    
+    if result is not None:
+        print(result)
+        return
+    
+    # Hand the request to a running server if there is one, otherwise answer it here
+    request = {
+        'mode': args.mode,
+        'model': args.model,
+        'target': target,
+        'config': asdict(config),
+        'prompt_cache': args.prompt_cache,
+        'semantic_cache': args.semantic_cache,
+        'stream': args.stream,
+        'persist_directory': PERSIST_DIRECTORY,
+        'storage_path': resolve_storage_path(args.storage_path),
+        'index_version': version
+    }
+    replies = forward_replies(request)
+    if replies is None:
+        replies = answer(load_assistant(args), request)
+    
+    # Show a streamed answer as it's generated, keeping the pieces for the cache
+    parts = []
+    cached_tokens = None
+    answer_version = version
+    for reply in replies:
+        if 'error' in reply:
+            sys.exit(f"Server error: {reply['error']}")
+        if 'delta' in reply:
+            parts.append(reply['delta'])
+            if args.stream:
+                sys.stdout.write(reply['delta'])
+                sys.stdout.flush()
+        else:
+            cached_tokens = reply['cached_tokens']
+            answer_version = reply.get('index_version', version)
+    result = "".join(parts)
     
-    print(result)
+    # Write a long answer to a slow terminal or pipe in the background while the cache is updated
+    with contextlib.ExitStack() as stack:
+        writer = threading.Thread(target=_write_all, args=("\n" if args.stream else result + "\n",))
+        writer.start()
+        stack.callback(writer.join)
+        if cache:
+            stack.callback(cache.close)
+            # A server that loaded a different index than the key names mustn't fill the cache
+            if answer_version == version:
+                cache.set(cache_key, result)
+    if args.prompt_cache and cached_tokens is not None:
+        print(f"Prompt tokens read from provider cache: {cached_tokens}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file